@@ -1,15 +1,41 @@
+import time
+
+# Measure how long the app takes to become importable (cold-start cost)
+_IMPORT_STARTED_AT = time.perf_counter()
+
 import os
 import logging
 import uuid
+import threading
 import csv
-import io
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import (
+    Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, g,
+    stream_with_context
+)
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
 import numpy as np
 from flask_cors import CORS
-from mcq_processor import preprocess_image, detect_grid, extract_answers, compare_answers, collect_training_data
+from session_store import SessionStore, CompactResult, encode_answers
+from storage import StorageManager
+from chunked_upload import ChunkedUploadManager, UploadError
+from overlays import save_bubble_layout, render_overlay, render_thumbnail
+from exports import (
+    FORMATS, columnar_available, response_columns, iter_response_rows, item_statistics, iter_csv,
+    iter_columnar
+)
+from exam_versions import (
+    MIN_MARGIN, VersionIndex, VersionNotIdentified, layout_fingerprint, next_label, parse_region
+)
+from duplicates import DuplicateIndex, fill_fingerprint, is_named
+from latency_budget import LatencyBudget, grade_sheet, training_allowed, stage_timings
+from grading_executor import DEFAULT_THREADS, GradingExecutor, GradingBusy
+from pipeline import PreprocessParams, load_sheet
+from mcq_processor import (
+    detect_grid, extract_answers, compare_answers, collect_training_data, start_warm_up_thread,
+    engine_status
+)
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -30,21 +56,447 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
 
-# In-memory storage for demo purposes
+# Each session's files live in UPLOAD_FOLDER/<session_id>/. Images older than
+# UPLOAD_ARCHIVE_AFTER_HOURS are replaced by downscaled JPEG copies (unless
+# UPLOAD_ARCHIVE=0), files older than UPLOAD_RETENTION_HOURS are deleted and
+# the oldest files of sessions no longer in use go first once UPLOAD_QUOTA_MB
+# is exceeded.
+storage = StorageManager(
+    UPLOAD_FOLDER,
+    retention=float(os.environ.get('UPLOAD_RETENTION_HOURS', 72)) * 3600,
+    archive_after=float(os.environ.get('UPLOAD_ARCHIVE_AFTER_HOURS', 6)) * 3600,
+    quota_bytes=int(float(os.environ.get('UPLOAD_QUOTA_MB', 1024)) * 1024 * 1024),
+    archive=os.environ.get('UPLOAD_ARCHIVE', '1') != '0',
+    sweep_interval=float(os.environ.get('UPLOAD_SWEEP_INTERVAL', 300)),
+    is_live=lambda session_id: session_id in sessions
+)
+
+
+def remove_session_files(session_id, session):
+    """Delete the uploaded files belonging to a session"""
+    storage.remove_session(session_id)
+
+
+# In-memory storage for demo purposes, bounded by SESSION_MEMORY_CAP_MB;
+# least recently used sessions are spilled to SESSION_SPILL_DIR and sessions
+# idle for SESSION_IDLE_TIMEOUT seconds are expired.
 # In a production environment, use a proper database
-sessions = {}
+sessions = SessionStore(
+    spill_dir=os.environ.get('SESSION_SPILL_DIR',
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'session_data')),
+    memory_cap=int(float(os.environ.get('SESSION_MEMORY_CAP_MB', 64)) * 1024 * 1024),
+    idle_timeout=float(os.environ.get('SESSION_IDLE_TIMEOUT', 4 * 3600)),
+    on_expire=remove_session_files
+)
+
+# Load the grading engine in the background so the app can answer health
+# checks immediately; set WARM_UP_ON_START=0 to load it on first request only
+if os.environ.get('WARM_UP_ON_START', '1') != '0':
+    start_warm_up_thread()
+
+STARTUP_SECONDS = time.perf_counter() - _IMPORT_STARTED_AT
+logger.info(f"App initialised in {STARTUP_SECONDS:.3f}s")
+
+
+# Default latency budget for webcam captures; other requests can pass
+# latencyBudgetMs explicitly. Over budget, grading degrades to cheaper tiers.
+WEBCAM_LATENCY_BUDGET_MS = float(os.environ.get('WEBCAM_LATENCY_BUDGET_MS', 400))
+
+
+def request_budget(mode):
+    """Latency budget for the current request, or None for unbudgeted grading"""
+    budget_ms = request.form.get('latencyBudgetMs', type=float)
+    if budget_ms is None and mode == 'webcam':
+        budget_ms = WEBCAM_LATENCY_BUDGET_MS
+    return LatencyBudget(budget_ms) if budget_ms else None
+
+
+# Fraction of the page ('x,y,w,h') where the exam version marker is printed;
+# by default the whole page layout is fingerprinted, which cannot tell apart
+# versions sharing a layout, so a session only takes a second version when
+# this is set
+VERSION_MARKER_REGION = parse_region(os.environ.get('VERSION_MARKER_REGION', ''))
+
+# Preprocessing settings ('name=value,...', e.g. 'blur=box,threshold=otsu')
+# for answer keys uploaded without their own 'preprocess' field
+DEFAULT_PREPROCESS = PreprocessParams.parse(os.environ.get('PREPROCESS_PARAMS', ''))
+
+# Captures in these modes are checked against the session's earlier sheets.
+# A capture whose marks differ from a sheet with the same student name in at
+# most DUPLICATE_MAX_DISTANCE bubbles, and whose answers are identical, is
+# answered with the earlier result instead of being stored again; other near
+# matches, and all unnamed captures, are stored and flagged as possible
+# duplicates (0 disables the check)
+DEDUPLICATE_MODES = ('realtime', 'webcam')
+DUPLICATE_MAX_DISTANCE = int(os.environ.get('DUPLICATE_MAX_DISTANCE', 1))
+
+# Appending a result and registering its index happen together, as request
+# threads record results concurrently
+results_lock = threading.Lock()
+
+# Sheets are decoded, preprocessed and read on a bounded per-process thread
+# pool (GRADING_THREADS=0 grades on the request thread). When
+# GRADING_MAX_PENDING sheets are queued or in progress, new requests wait up
+# to GRADING_QUEUE_TIMEOUT seconds and are then answered with 503.
+GRADING_THREADS = int(os.environ.get('GRADING_THREADS', DEFAULT_THREADS))
+GRADING_RETRY_AFTER = 2
+grading_executor = GradingExecutor(
+    threads=GRADING_THREADS,
+    max_pending=int(os.environ.get('GRADING_MAX_PENDING', max(GRADING_THREADS, 1) * 4)),
+    wait_timeout=float(os.environ.get('GRADING_QUEUE_TIMEOUT', 5))
+)
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def auto_save_csv(session_id, prefix):
+    """
+    Write all results of a session to a CSV in its upload directory
+    
+    Each snapshot contains every result so far, so older snapshots of the
+    session are removed when a new one is written.
+    """
+    session = sessions[session_id]
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    csv_path = storage.session_path(session_id, f"{prefix}_{timestamp}.csv")
+    
+    # Create CSV file
+    with open(csv_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        # Write header
+        writer.writerow(['Student Name', 'Score', 'Total', 'Percentage', 'Timestamp', 'Detection Mode'])
+        # Write all results in the session
+        for r in session['results']:
+            writer.writerow([
+                r.student_name,
+                r.score,
+                r.total,
+                f"{r.percentage:.2f}%",
+                r.timestamp,
+                r.mode
+            ])
+    
+    # Replace superseded snapshots with this one
+    for old_path in session.get('csv_files', []):
+        if old_path != csv_path and os.path.exists(old_path):
+            os.remove(old_path)
+    session['csv_files'] = [csv_path]
+    return csv_path
+
+
+def select_version(session, filepath, label=None):
+    """
+    Pick the answer key version a sheet is graded against
+    
+    An explicit label wins; with a single version no routing is needed;
+    otherwise the sheet's fingerprint is looked up in the version index.
+    
+    Raises:
+        ValueError: The label is unknown
+        VersionNotIdentified: The sheet cannot be routed with confidence
+    """
+    versions = session['versions']
+    if label:
+        if label not in versions:
+            raise ValueError(f"Unknown exam version {label}")
+        return label
+    if len(versions) == 1:
+        return next(iter(versions))
+    label, distance = session['version_index'].route(layout_fingerprint(filepath, VERSION_MARKER_REGION))
+    logger.info(f"Routed sheet to version {label} (distance {distance})")
+    return label
+
+
+def question_count(session):
+    """Number of questions in the longest answer key of a session"""
+    return max(len(v['answer_key']) for v in session['versions'].values())
+
+
+def find_duplicate(session, outcome, student_name):
+    """
+    Look up an earlier sheet a graded capture may duplicate
+    
+    Args:
+        session (dict): Session the capture belongs to
+        outcome (dict): Result of grade_sheet for the capture
+        student_name (str): Name entered for the capture
+    
+    Returns:
+        tuple: (result index or None, distance, fingerprint)
+    """
+    fingerprint = fill_fingerprint(outcome['sheet'], outcome['grid_coords'])
+    if fingerprint is None:
+        return None, None, None
+    index, distance = session['duplicate_index'].find(fingerprint, student_name, DUPLICATE_MAX_DISTANCE)
+    return index, distance, fingerprint
+
+
+def grade_file(session, filepath, student_name, mode, budget=None, version=None, allow_duplicate=False):
+    """
+    Pick the answer key version, extract answers and check for duplicates
+    
+    Runs on the grading executor and only reads the session, so several
+    sheets can be graded at once; record_grading then stores the outcome.
+    
+    Args:
+        session (dict): Session the sheet belongs to
+        filepath (str): Where the sheet was saved
+        student_name (str): Student's name
+        mode (str): Detection mode ('manual', 'realtime', 'webcam' or 'batch')
+        budget (LatencyBudget): Time allowance, or None
+        version (str): Exam version, or None to identify it from the sheet
+        allow_duplicate (bool): Store the sheet even if it looks like a duplicate
+        
+    Returns:
+        dict: label, fingerprint (or None), outcome (the result of
+            grade_sheet) and, for a near match, candidate as
+            (result index, distance)
+    """
+    label = select_version(session, filepath, version)
+    key = session['versions'][label]
+    graded = {'label': label, 'fingerprint': None}
+    graded['outcome'] = grade_sheet(filepath, key['grid_coords'], budget, key.get('preprocess'))
+    
+    if mode in DEDUPLICATE_MODES and DUPLICATE_MAX_DISTANCE > 0:
+        index, distance, graded['fingerprint'] = find_duplicate(session, graded['outcome'], student_name)
+        if index is not None and not allow_duplicate:
+            # Confirmed against the extracted answers in record_grading
+            graded['candidate'] = (index, distance)
+    return graded
+
+
+def record_grading(session, graded, filepath, filename, student_name, mode, budget=None):
+    """
+    Score a graded sheet, collect training data and store the result
+    
+    Args:
+        session (dict): Session the sheet belongs to
+        graded (dict): Result of grade_file
+        filepath (str): Where the sheet was saved
+        filename (str): Name recorded with the result
+        student_name (str): Student's name
+        mode (str): Detection mode
+        budget (LatencyBudget): Time allowance, or None
+        
+    Returns:
+        dict: Response payload, or None if no answers could be extracted;
+            duplicate_of is set when the sheet repeats an earlier result and
+            was not stored, possible_duplicate_of when it was stored but
+            may be a repeat
+    """
+    label = graded['label']
+    key = session['versions'][label]
+    
+    outcome = graded['outcome']
+    student_answers = outcome['answers']
+    if not student_answers:
+        return None
+    
+    possible_duplicate = None
+    if 'candidate' in graded:
+        index, distance = graded['candidate']
+        earlier = session['results'][index]
+        same_answers = (earlier.version == label and
+                        earlier.answer_codes == encode_answers(student_answers, len(key['answer_codes'])))
+        if same_answers and is_named(student_name):
+            logger.info(f"Sheet {filename} duplicates result {index} (distance {distance}), not stored again")
+            storage.remove_file(filepath)
+            payload = earlier.to_dict()
+            del payload['filename'], payload['timestamp']
+            payload.update({'mode': mode, 'duplicate_of': index, 'distance': distance})
+            return payload
+        possible_duplicate = {'possible_duplicate_of': index, 'distance': distance}
+    
+    # Compare with answer key
+    correct_answers = key['answer_key']
+    score, details = compare_answers(correct_answers, student_answers)
+    
+    # If score is high enough (at least 70%), use for training data
+    # (skipped when grading had to take a faster tier or time is short)
+    if score / len(correct_answers) >= 0.7 and training_allowed(outcome, budget):
+        with stage_timings.measure('training'):
+            collect_training_data(outcome['sheet'], outcome['grid_coords'], student_answers)
+        logger.info(f"Collected training data from {mode} sheet with {len(student_answers)} answers")
+    
+    # Store result
+    result = CompactResult.from_grading(
+        student_name, filename, key['answer_codes'], student_answers,
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S'), mode, version=label, sheet_path=filepath
+    )
+    # Bubble positions and decisions, for overlays rendered on demand
+    save_bubble_layout(filepath, outcome['bubbles'], outcome['image_size'])
+    with results_lock:
+        session['student_sheets'].append(filepath)
+        session['results'].append(result)
+        if graded['fingerprint'] is not None:
+            session['duplicate_index'].add(graded['fingerprint'], len(session['results']) - 1, student_name)
+    
+    payload = {
+        'student_name': student_name,
+        'score': score,
+        'total': len(correct_answers),
+        'percentage': result.percentage,
+        'details': details,
+        'mode': mode,
+        'version': label,
+        'tier': outcome['tier'],
+        'degraded': outcome['degraded'],
+        'confidence': outcome['confidence']
+    }
+    if possible_duplicate is not None:
+        payload.update(possible_duplicate)
+    return payload
+
+
+def grade_and_record(session_id, filepath, filename, student_name, mode, budget=None, version=None,
+                     allow_duplicate=False, background=False):
+    """
+    Grade a saved sheet against its answer key version and store the result
+    
+    In realtime and webcam modes, a named sheet that repeats an earlier one
+    (near-identical grid, same name and answers) is not stored: its file is
+    removed and the earlier result is returned with 'duplicate_of' set to
+    that result's index. Other near matches are stored with
+    'possible_duplicate_of' set.
+    
+    Args:
+        session_id (str): Session the sheet belongs to
+        filepath (str): Where the sheet was saved
+        filename (str): Name recorded with the result
+        student_name (str): Student's name
+        mode (str): Detection mode ('manual', 'realtime' or 'webcam')
+        budget (LatencyBudget): Time allowance, or None
+        version (str): Exam version, or None to identify it from the sheet
+        allow_duplicate (bool): Store the sheet even if it looks like a duplicate
+        background (bool): Wait for a grading slot however long the queue
+            is busy, instead of failing with GradingBusy
+        
+    Returns:
+        dict: Response payload, or None if no answers could be extracted
+        
+    Raises:
+        GradingBusy: The grading queue is full (not raised in the background)
+    """
+    session = sessions[session_id]
+    submit = grading_executor.submit_waiting if background else grading_executor.submit
+    graded = submit(grade_file, session, filepath, student_name, mode, budget, version,
+                    allow_duplicate).result()
+    return record_grading(session, graded, filepath, filename, student_name, mode, budget)
+
+
+def busy_response(error):
+    """503 answer for a request turned away because the grading queue is full"""
+    response = jsonify({'error': str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(GRADING_RETRY_AFTER)
+    return response
+
+
+def version_response(error, session_id):
+    """422 answer for a sheet whose exam version must be given explicitly"""
+    return jsonify({
+        'error': f"{error}. Resubmit with the 'version' field set.",
+        'versions': list(sessions[session_id]['versions'])
+    }), 422
+
+
+def grade_uploaded_file(session_id, filepath, filename):
+    """
+    Grade a sheet that arrived through a chunked upload (runs in a background
+    thread); the file is removed if the sheet is not stored
+    """
+    try:
+        if session_id not in sessions:
+            raise ValueError('Session no longer exists')
+        with sessions.pinned(session_id):
+            payload = grade_and_record(session_id, filepath, filename, filename.rsplit('.', 1)[0], 'batch',
+                                       background=True)
+        if payload is None:
+            raise ValueError('Could not extract answers')
+    except Exception:
+        storage.remove_file(filepath)
+        raise
+    payload.pop('details')
+    return payload
+
+
+# Resumable uploads for scans and ZIPs larger than MAX_CONTENT_LENGTH; each
+# chunk must still fit in MAX_CONTENT_LENGTH. ZIP members over
+# CHUNKED_MAX_MEMBER_MB uncompressed, or compressed more than
+# CHUNKED_MAX_MEMBER_RATIO times, are rejected.
+chunked_uploads = ChunkedUploadManager(
+    storage, grade_uploaded_file, ALLOWED_EXTENSIONS,
+    max_size=int(float(os.environ.get('CHUNKED_UPLOAD_MAX_MB', 2048)) * 1024 * 1024),
+    grading_threads=int(os.environ.get('CHUNKED_GRADING_THREADS', 1)),
+    max_member_size=int(float(os.environ.get('CHUNKED_MAX_MEMBER_MB', 32)) * 1024 * 1024),
+    max_member_ratio=float(os.environ.get('CHUNKED_MAX_MEMBER_RATIO', 100))
+)
+
+
+@app.before_request
+def ensure_storage_sweeper():
+    # Started per process on first request: threads do not survive the fork
+    # from a preloaded gunicorn master
+    storage.start_sweeper()
+
+
+def pin_request_session(session_id):
+    """Keep a session in memory until the current request has finished"""
+    sessions.pin(session_id)
+    g.pinned_sessions.append(session_id)
+
+
+@app.before_request
+def pin_session():
+    # Routes mutate the session dict they read, so it must not be spilled
+    # to disk while the request holds it
+    g.pinned_sessions = []
+    session_id = (request.view_args or {}).get('session_id')
+    if session_id is None and request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        session_id = request.form.get('sessionId')
+    if session_id:
+        pin_request_session(session_id)
+
+
+@app.teardown_request
+def unpin_session(error=None):
+    for session_id in g.pop('pinned_sessions', []):
+        sessions.unpin(session_id)
+
+
 @app.route('/')
 def index():
     # Pass the current datetime to the template for the copyright year
     return render_template('index.html', now=datetime.now())
 
 
+@app.route('/healthz')
+def healthz():
+    """Liveness check: the web process is up"""
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/ready')
+def ready():
+    """Readiness check: the grading engine is loaded and warm"""
+    status = engine_status()
+    status['startup_seconds'] = STARTUP_SECONDS
+    return jsonify(status), 200 if status['state'] == 'ready' else 503
+
+
+@app.route('/stats')
+def stats():
+    """Resource usage of this worker"""
+    return jsonify({
+        'sessions': sessions.stats(),
+        'storage': storage.stats(),
+        'stage_timings_ms': stage_timings.snapshot(),
+        'grading': grading_executor.stats()
+    })
+
+
 @app.route('/upload-answer-key', methods=['POST'])
 def upload_answer_key():
     if 'answerKey' not in request.files:
@@ -57,47 +509,103 @@ def upload_answer_key():
         return redirect(request.url)
     
     if file and allowed_file(file.filename):
-        # Create a new session
-        session_id = str(uuid.uuid4())
+        # Add a version to an existing session, or create a new session
+        session_id = request.form.get('sessionId')
+        is_new_session = not session_id or session_id not in sessions
+        if is_new_session:
+            session_id = str(uuid.uuid4())
+            pin_request_session(session_id)
+            label = request.form.get('version') or 'A'
+        else:
+            existing = sessions[session_id]['versions']
+            label = request.form.get('version')
+            if not label:
+                # An explicit label replaces that version's key; an implicit one never does
+                label = next_label(existing)
+                if label is None:
+                    return jsonify({'error': 'All version labels A-Z are in use; name the version '
+                                             'to replace its answer key'}), 409
+            if VERSION_MARKER_REGION is None and set(existing) - {label}:
+                return jsonify({'error': 'Several exam versions need VERSION_MARKER_REGION to be configured, '
+                                         'so that sheets can be told apart'}), 400
+        
+        # The layout's preprocessing settings apply to every sheet graded against this key
+        preprocess = request.form.get('preprocess')
+        try:
+            params = PreprocessParams.parse(preprocess) if preprocess else DEFAULT_PREPROCESS
+        except ValueError as e:
+            return jsonify({'error': f"Invalid preprocessing settings: {e}"}), 400
+        
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{session_id}_{filename}")
-        file.save(filepath)
+        filepath = storage.session_path(session_id, f"key_{label}_{filename}")
+        
+        def discard_upload():
+            if is_new_session:
+                storage.remove_session(session_id)
+            else:
+                storage.remove_file(filepath)
         
         try:
+            file.save(filepath)
+            
             # Process the answer key
-            img = preprocess_image(filepath)
-            grid_coords = detect_grid(img)
+            sheet = load_sheet(filepath, params=params)
+            grid_coords = detect_grid(sheet)
             if grid_coords is None:
                 flash('Could not detect MCQ grid in the answer key', 'danger')
-                os.remove(filepath)
+                discard_upload()
                 return redirect(url_for('index'))
             
-            answers = extract_answers(img, grid_coords)
+            answers = extract_answers(sheet, grid_coords)
             if not answers:
                 flash('Could not extract answers from the answer key', 'danger')
-                os.remove(filepath)
+                discard_upload()
                 return redirect(url_for('index'))
             
+            # Sheets could not be routed if this key's marker looks like another version's
+            fingerprint = layout_fingerprint(filepath, VERSION_MARKER_REGION)
+            if not is_new_session:
+                ranked = sessions[session_id]['version_index'].ranked(fingerprint, exclude=label)
+                if ranked and ranked[0][0] < MIN_MARGIN:
+                    discard_upload()
+                    return jsonify({'error': f"The version marker of {label} cannot be told apart from "
+                                             f"version {ranked[0][1]} ({ranked[0][0]} bits differ)"}), 400
+            
             # Store session data
-            sessions[session_id] = {
+            if is_new_session:
+                sessions[session_id] = {
+                    'versions': {},
+                    'version_index': VersionIndex(),
+                    'duplicate_index': DuplicateIndex(),
+                    'student_sheets': [],
+                    'results': []
+                }
+            session = sessions[session_id]
+            session['versions'][label] = {
                 'answer_key': answers,
+                'answer_codes': encode_answers(answers),
+                'answer_key_file': filepath,
                 'grid_coords': grid_coords,
-                'student_sheets': [],
-                'results': []
+                'preprocess': params
             }
+            session['version_index'].add(label, fingerprint)
             
             # Train ML model with the answer key data
-            collect_training_data(img, grid_coords, answers)
+            collect_training_data(sheet, grid_coords, answers)
             logger.info(f"Collected training data from answer key with {len(answers)} answers")
             
             flash('Answer key uploaded successfully', 'success')
-            return jsonify({'session_id': session_id, 'message': 'Answer key processed successfully'})
+            return jsonify({
+                'session_id': session_id,
+                'version': label,
+                'versions': list(session['versions']),
+                'message': 'Answer key processed successfully'
+            })
         
         except Exception as e:
             logger.error(f"Error processing answer key: {str(e)}")
             flash(f"Error processing answer key: {str(e)}", 'danger')
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            discard_upload()
             return jsonify({'error': str(e)}), 500
     
     flash('Invalid file type. Please upload a PNG, JPG, JPEG or PDF file.', 'danger')
@@ -112,6 +620,7 @@ def upload_student_sheet():
         return redirect(url_for('index'))
     
     mode = request.form.get('mode', 'manual')  # Get the mode: 'manual', 'realtime', or 'webcam'
+    budget = request_budget(mode)
     
     if 'studentSheet' not in request.files:
         flash('No file part', 'danger')
@@ -124,88 +633,42 @@ def upload_student_sheet():
     
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{session_id}_student_{filename}")
-        file.save(filepath)
+        # Prefix with a short unique id so sheets with the same name do not overwrite each other
+        filepath = storage.session_path(session_id, f"student_{uuid.uuid4().hex[:8]}_{filename}")
         
         try:
+            file.save(filepath)
+            
             # Process the student sheet
-            img = preprocess_image(filepath)
-            grid_coords = sessions[session_id]['grid_coords']
-            student_answers = extract_answers(img, grid_coords)
+            payload = grade_and_record(
+                session_id, filepath, filename, request.form.get('studentName', 'Unknown'),
+                mode, budget, request.form.get('version'), request.form.get('allowDuplicate') == '1'
+            )
             
-            if not student_answers:
+            if payload is None:
                 flash('Could not extract answers from the student sheet', 'danger')
-                os.remove(filepath)
+                storage.remove_file(filepath)
                 return redirect(url_for('index'))
             
-            # Compare with answer key
-            correct_answers = sessions[session_id]['answer_key']
-            score, details = compare_answers(correct_answers, student_answers)
-            
-            # If score is high enough (at least 70%), use for training data
-            if score / len(correct_answers) >= 0.7:
-                collect_training_data(img, grid_coords, student_answers)
-                logger.info(f"Collected training data from student sheet with {len(student_answers)} answers")
-            
-            # Store result
-            student_name = request.form.get('studentName', 'Unknown')
-            result = {
-                'student_name': student_name,
-                'filename': filename,
-                'score': score,
-                'total': len(correct_answers),
-                'percentage': (score / len(correct_answers)) * 100 if len(correct_answers) > 0 else 0,
-                'details': details,
-                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'mode': mode
-            }
-            
-            sessions[session_id]['student_sheets'].append(filepath)
-            sessions[session_id]['results'].append(result)
-            
-            # If in real-time mode, automatically save to CSV
-            if mode == 'realtime' or mode == 'webcam':
-                # Create a timestamp for the filename
-                timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-                csv_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{session_id}_realtime_{timestamp}.csv")
-                
-                # Create CSV file
-                with open(csv_path, 'w', newline='') as csvfile:
-                    writer = csv.writer(csvfile)
-                    # Write header
-                    writer.writerow(['Student Name', 'Score', 'Total', 'Percentage', 'Timestamp', 'Detection Mode'])
-                    # Write all results in the session
-                    for r in sessions[session_id]['results']:
-                        writer.writerow([
-                            r['student_name'],
-                            r['score'],
-                            r['total'],
-                            f"{r['percentage']:.2f}%",
-                            r['timestamp'],
-                            r.get('mode', 'manual')
-                        ])
-                
-                # Add CSV path to session data
-                if 'csv_files' not in sessions[session_id]:
-                    sessions[session_id]['csv_files'] = []
-                sessions[session_id]['csv_files'].append(csv_path)
+            # If in real-time mode, automatically save to CSV (nothing new for a duplicate)
+            auto_save = (mode == 'realtime' or mode == 'webcam') and 'duplicate_of' not in payload
+            if auto_save:
+                auto_save_csv(session_id, 'realtime')
             
             # Return result
-            return jsonify({
-                'student_name': student_name,
-                'score': score,
-                'total': len(correct_answers),
-                'percentage': (score / len(correct_answers)) * 100 if len(correct_answers) > 0 else 0,
-                'details': details,
-                'mode': mode,
-                'auto_saved': mode == 'realtime' or mode == 'webcam'
-            })
+            payload['auto_saved'] = auto_save
+            return jsonify(payload)
         
+        except GradingBusy as e:
+            storage.remove_file(filepath)
+            return busy_response(e)
+        except VersionNotIdentified as e:
+            storage.remove_file(filepath)
+            return version_response(e, session_id)
         except Exception as e:
             logger.error(f"Error processing student sheet: {str(e)}")
             flash(f"Error processing student sheet: {str(e)}", 'danger')
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            storage.remove_file(filepath)
             return jsonify({'error': str(e)}), 500
     
     flash('Invalid file type. Please upload a PNG, JPG, JPEG or PDF file.', 'danger')
@@ -226,89 +689,139 @@ def process_webcam_image():
     if not file:
         return jsonify({'error': 'Empty file received'}), 400
     
+    budget = request_budget('webcam')
+    
+    # Save the captured image
+    filename = f"webcam_capture_{uuid.uuid4()}.jpg"
+    filepath = storage.session_path(session_id, filename)
+    
     try:
-        # Save the captured image
-        filename = f"webcam_capture_{uuid.uuid4()}.jpg"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{session_id}_{filename}")
         file.save(filepath)
         
         # Process the captured image
-        img = preprocess_image(filepath)
-        grid_coords = sessions[session_id]['grid_coords']
-        student_answers = extract_answers(img, grid_coords)
+        payload = grade_and_record(
+            session_id, filepath, filename, request.form.get('studentName', 'Unknown'),
+            'webcam', budget, request.form.get('version'), request.form.get('allowDuplicate') == '1'
+        )
         
-        if not student_answers:
-            os.remove(filepath)
+        if payload is None:
+            storage.remove_file(filepath)
             return jsonify({'error': 'Could not extract answers from the image'}), 400
         
-        # Compare with answer key
-        correct_answers = sessions[session_id]['answer_key']
-        score, details = compare_answers(correct_answers, student_answers)
-        
-        # If score is high enough (at least 70%), use for training data
-        if score / len(correct_answers) >= 0.7:
-            collect_training_data(img, grid_coords, student_answers)
-            logger.info(f"Collected training data from webcam image with {len(student_answers)} answers")
-        
-        # Store result
-        student_name = request.form.get('studentName', 'Unknown')
-        result = {
-            'student_name': student_name,
-            'filename': filename,
-            'score': score,
-            'total': len(correct_answers),
-            'percentage': (score / len(correct_answers)) * 100 if len(correct_answers) > 0 else 0,
-            'details': details,
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'mode': 'webcam'
-        }
-        
-        sessions[session_id]['student_sheets'].append(filepath)
-        sessions[session_id]['results'].append(result)
-        
-        # Automatically save to CSV (real-time mode)
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        csv_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{session_id}_webcam_{timestamp}.csv")
-        
-        # Create CSV file
-        with open(csv_path, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            # Write header
-            writer.writerow(['Student Name', 'Score', 'Total', 'Percentage', 'Timestamp', 'Detection Mode'])
-            # Write all results in the session
-            for r in sessions[session_id]['results']:
-                writer.writerow([
-                    r['student_name'],
-                    r['score'],
-                    r['total'],
-                    f"{r['percentage']:.2f}%",
-                    r['timestamp'],
-                    r.get('mode', 'manual')
-                ])
-        
-        # Add CSV path to session data
-        if 'csv_files' not in sessions[session_id]:
-            sessions[session_id]['csv_files'] = []
-        sessions[session_id]['csv_files'].append(csv_path)
+        # Automatically save to CSV (real-time mode); a duplicate adds nothing new
+        payload['auto_saved'] = 'duplicate_of' not in payload
+        if payload['auto_saved']:
+            auto_save_csv(session_id, 'webcam')
         
         # Return result
-        return jsonify({
-            'student_name': student_name,
-            'score': score,
-            'total': len(correct_answers),
-            'percentage': (score / len(correct_answers)) * 100 if len(correct_answers) > 0 else 0,
-            'details': details,
-            'mode': 'webcam',
-            'auto_saved': True
-        })
+        return jsonify(payload)
     
+    except GradingBusy as e:
+        storage.remove_file(filepath)
+        return busy_response(e)
+    except VersionNotIdentified as e:
+        storage.remove_file(filepath)
+        return version_response(e, session_id)
     except Exception as e:
         logger.error(f"Error processing webcam image: {str(e)}")
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        storage.remove_file(filepath)
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/upload-student-sheets', methods=['POST'])
+def upload_student_sheets():
+    """Grade a mixed stack of sheets, routing each to its exam version"""
+    session_id = request.form.get('sessionId')
+    if not session_id or session_id not in sessions:
+        return jsonify({'error': 'Invalid session. Please start over by uploading an answer key first.'}), 400
+    
+    files = request.files.getlist('studentSheets')
+    if not files:
+        return jsonify({'error': 'No files found in request'}), 400
+    
+    session = sessions[session_id]
+    saved = []  # (filename, filepath)
+    errors = []
+    for file in files:
+        if not file or not allowed_file(file.filename):
+            errors.append({'filename': file.filename, 'error': 'Invalid file type'})
+            continue
+        
+        filename = secure_filename(file.filename)
+        filepath = storage.session_path(session_id, f"student_{uuid.uuid4().hex[:8]}_{filename}")
+        file.save(filepath)
+        saved.append((filename, filepath))
+    
+    def grade_item(item):
+        filename, filepath = item
+        # Sheets in a stack are named after their file
+        return grade_file(session, filepath, filename.rsplit('.', 1)[0], 'batch')
+    
+    # Sheets are graded concurrently on the executor and recorded in upload order
+    graded = []
+    done = 0
+    try:
+        for (filename, filepath), future in grading_executor.map(grade_item, saved):
+            done += 1
+            try:
+                payload = record_grading(session, future.result(), filepath, filename,
+                                         filename.rsplit('.', 1)[0], 'batch')
+                if payload is None:
+                    storage.remove_file(filepath)
+                    errors.append({'filename': filename, 'error': 'Could not extract answers'})
+                    continue
+                payload.pop('details')
+                graded.append(payload)
+            except Exception as e:
+                logger.error(f"Error processing student sheet {filename}: {str(e)}")
+                storage.remove_file(filepath)
+                errors.append({'filename': filename, 'error': str(e)})
+    except GradingBusy as e:
+        # Sheets that could not be queued; those already queued are graded
+        # but not recorded, so their files go too
+        for filename, filepath in saved[done:]:
+            storage.remove_file(filepath)
+            errors.append({'filename': filename, 'error': str(e)})
+    
+    return jsonify({'results': graded, 'errors': errors})
+
+
+@app.route('/uploads', methods=['POST'])
+def create_chunked_upload():
+    """Start a resumable upload; chunks are then PATCHed to the returned URL"""
+    session_id = request.form.get('sessionId')
+    if not session_id or session_id not in sessions:
+        return jsonify({'error': 'Invalid session. Please start over by uploading an answer key first.'}), 400
+    
+    try:
+        upload_id = chunked_uploads.create(
+            session_id, request.form.get('filename', ''), request.form.get('size', 0, type=int))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    return jsonify({
+        'upload_id': upload_id,
+        'upload_url': url_for('chunked_upload', upload_id=upload_id),
+        'offset': 0
+    }), 201
+
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PATCH'])
+def chunked_upload(upload_id):
+    """Report an upload's offset and results, or append a chunk to it"""
+    try:
+        if request.method == 'GET':
+            return jsonify(chunked_uploads.status(upload_id))
+        
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None:
+            return jsonify({'error': 'Missing Upload-Offset header'}), 400
+        new_offset = chunked_uploads.append(upload_id, offset, request.stream)
+        return jsonify({'upload_id': upload_id, 'offset': new_offset})
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+
+
 @app.route('/results/<session_id>')
 def results(session_id):
     if session_id not in sessions:
@@ -317,58 +830,114 @@ def results(session_id):
     
     return render_template('results.html', 
                           session_id=session_id, 
-                          results=sessions[session_id]['results'],
-                          num_questions=len(sessions[session_id]['answer_key']),
+                          results=[r.to_dict() for r in sessions[session_id]['results']],
+                          num_questions=question_count(sessions[session_id]),
                           now=datetime.now())
 
 
+def sheet_overlay_path(session_id, index):
+    """Render (once) and return the overlay of a graded sheet, or None if its files are gone"""
+    if session_id not in sessions:
+        return None
+    results = sessions[session_id]['results']
+    if not 0 <= index < len(results) or results[index].sheet_path is None:
+        return None
+    result = results[index]
+    image_path = storage.resolve(result.sheet_path)
+    if image_path is None:
+        return None
+    return render_overlay(result.sheet_path, image_path, result.key_codes, result.answer_codes)
+
+
+@app.route('/results/<session_id>/sheets/<int:index>/overlay.jpg')
+def sheet_overlay(session_id, index):
+    """Annotated sheet image, generated on first request and cached on disk"""
+    overlay_path = sheet_overlay_path(session_id, index)
+    if overlay_path is None:
+        return jsonify({'error': 'Sheet not found'}), 404
+    try:
+        # conditional=True answers If-None-Match / If-Modified-Since with 304
+        return send_file(overlay_path, mimetype='image/jpeg', conditional=True, etag=True, max_age=3600)
+    except FileNotFoundError:
+        # Removed by the storage sweep since it was rendered
+        return jsonify({'error': 'Sheet not found'}), 404
+
+
+@app.route('/results/<session_id>/sheets/<int:index>/thumbnail.jpg')
+def sheet_thumbnail(session_id, index):
+    """Small version of the annotated sheet for the results page"""
+    overlay_path = sheet_overlay_path(session_id, index)
+    thumbnail_path = render_thumbnail(overlay_path) if overlay_path is not None else None
+    if thumbnail_path is None:
+        return jsonify({'error': 'Sheet not found'}), 404
+    try:
+        return send_file(thumbnail_path, mimetype='image/jpeg', conditional=True, etag=True, max_age=3600)
+    except FileNotFoundError:
+        return jsonify({'error': 'Sheet not found'}), 404
+
+
+def export_response(chunks, fmt, name):
+    """Stream export chunks as a file download"""
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    return Response(
+        stream_with_context(chunks),
+        mimetype=FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename=mcq_{name}_{timestamp}.{fmt}'}
+    )
+
+
 @app.route('/export-csv/<session_id>')
 def export_csv(session_id):
     if session_id not in sessions:
         flash('Session not found.', 'danger')
         return redirect(url_for('index'))
     
-    results = sessions[session_id]['results']
-    if not results:
+    session = sessions[session_id]
+    if not session['results']:
         flash('No results to export.', 'warning')
         return redirect(url_for('results', session_id=session_id))
     
-    # Create in-memory CSV file
-    output = io.StringIO()
-    csv_writer = csv.writer(output)
-    
-    # Write header
-    csv_writer.writerow(['Student Name', 'Score', 'Total', 'Percentage', 'Timestamp', 'Detection Mode'])
-    
-    # Write data
-    for result in results:
-        csv_writer.writerow([
-            result['student_name'],
-            result['score'],
-            result['total'],
-            f"{result['percentage']:.2f}%",
-            result['timestamp'],
-            result.get('mode', 'manual')
-        ])
-    
-    # Prepare response
-    output.seek(0)
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    return send_file(
-        io.BytesIO(output.getvalue().encode('utf-8')),
-        as_attachment=True,
-        download_name=f'mcq_results_{timestamp}.csv',
-        mimetype='text/csv'
-    )
+    # Rows are generated while the response is sent, not built up front;
+    # Percentage keeps this route's original "85.00%" format
+    n_questions = question_count(session)
+    rows = iter_response_rows(session['results'], n_questions, percent_sign=True)
+    return export_response(iter_csv(response_columns(n_questions), rows), 'csv', 'results')
+
+
+@app.route('/export/<session_id>/<kind>.<fmt>')
+def export_session(session_id, kind, fmt):
+    """
+    Export a session's responses (one row per student, one column per
+    question) or item statistics (one row per question) as CSV, Parquet or
+    Arrow IPC
+    """
+    if session_id not in sessions:
+        return jsonify({'error': 'Session not found'}), 404
+    if kind not in ('responses', 'items') or fmt not in FORMATS:
+        return jsonify({'error': 'Unknown export'}), 404
+    if fmt != 'csv' and not columnar_available():
+        return jsonify({'error': f'{fmt} export requires pyarrow'}), 501
+
+    session = sessions[session_id]
+    if not session['results']:
+        return jsonify({'error': 'No results to export'}), 404
+
+    if kind == 'responses':
+        n_questions = question_count(session)
+        columns = response_columns(n_questions)
+        rows = iter_response_rows(session['results'], n_questions)
+    else:
+        columns, rows = item_statistics(session['results'])
+
+    chunks = iter_csv(columns, rows) if fmt == 'csv' else iter_columnar(columns, rows, fmt)
+    return export_response(chunks, fmt, kind)
 
 
 @app.route('/clear-session/<session_id>')
 def clear_session(session_id):
     if session_id in sessions:
         # Clean up uploaded files
-        for filepath in sessions[session_id].get('student_sheets', []):
-            if os.path.exists(filepath):
-                os.remove(filepath)
+        remove_session_files(session_id, sessions[session_id])
         
         # Remove session data
         del sessions[session_id]
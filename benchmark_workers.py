@@ -0,0 +1,91 @@
+"""
+Benchmark gunicorn worker/thread combinations
+Starts gunicorn (using gunicorn.conf.py) once per combination, uploads an
+answer key, then grades the same student sheet repeatedly at a fixed client
+concurrency and reports throughput and latency percentiles. Requests are
+sent with load_test.run_load; use load_test.py directly to drive a mix of
+endpoints against a server that is already running.
+
+Usage:
+    python benchmark_workers.py --threads 1 4 8 \\
+        --answer-key key.jpg --student-sheet sheet.jpg --requests 200
+
+Sessions live in the memory of the worker that created them, so with more
+than one worker most grading requests reach a worker that does not know the
+session and fail; such runs show the cost of that split, not a usable setup.
+
+Note that uploading an answer key retrains the model under static/models,
+so run this from a scratch checkout if the shipped model must not change.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+from load_test import create_sessions, run_load, wait_until_ready
+
+
+def run_combination(n_workers, n_threads, args):
+    """
+    Benchmark one worker/thread combination
+
+    Returns:
+        dict: Throughput, latency percentiles and error count
+    """
+    env = dict(os.environ, GUNICORN_WORKERS=str(n_workers), GUNICORN_THREADS=str(n_threads))
+    bind = f"127.0.0.1:{args.port}"
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', '--bind', bind, 'main:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f"http://{bind}"
+    try:
+        if not wait_until_ready(base_url):
+            raise RuntimeError(f"gunicorn did not become ready ({n_workers}w x {n_threads}t)")
+
+        with open(args.answer_key, 'rb') as f:
+            key = (os.path.basename(args.answer_key), f.read())
+        with open(args.student_sheet, 'rb') as f:
+            sheet = (os.path.basename(args.student_sheet), f.read(), None)
+
+        session_ids = create_sessions(base_url, key, 1)
+        report = run_load(base_url, session_ids, [sheet], ['upload-student-sheet'],
+                          requests=args.requests, concurrency=args.concurrency)['all']
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'workers': n_workers,
+        'threads': n_threads,
+        'requests': report['requests'],
+        'errors': report['errors'],
+        'throughput_rps': report['throughput_rps'],
+        'p50_ms': report.get('p50_ms', 0.0),
+        'p95_ms': report.get('p95_ms', 0.0),
+        'p99_ms': report.get('p99_ms', 0.0)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--answer-key', required=True)
+    parser.add_argument('--student-sheet', required=True)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    print(f"{'workers':>7} {'threads':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+    for n_workers in args.workers:
+        for n_threads in args.threads:
+            r = run_combination(n_workers, n_threads, args)
+            print(f"{r['workers']:>7} {r['threads']:>7} {r['throughput_rps']:>8.2f} {r['p50_ms']:>8.1f} "
+                  f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['errors']:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""
+Chunked, resumable uploads
+Large scans and ZIPs of a whole class are sent as a sequence of raw chunks:
+
+    POST  /uploads               create an upload (sessionId, filename, size)
+    PATCH /uploads/<upload_id>   append a chunk; the Upload-Offset header must
+                                 equal the bytes received so far
+    GET   /uploads/<upload_id>   current offset (to resume) and grading results
+
+Chunks are streamed straight to a .part file in the session's directory, and
+the file size on disk is the source of truth for the offset, so any worker
+can accept the next chunk. Completed files are graded in a background thread.
+For ZIPs, members are extracted and graded as soon as all of their bytes have
+arrived, while later chunks are still being uploaded; members that cannot be
+walked that way (sizes given in a data descriptor after the data) are
+extracted in the background once the upload completes. Members are tracked by
+the offset of their local header, which names cannot do reliably: zipfile
+decodes names without the UTF-8 flag as cp437. Only members with a
+sheet extension are extracted, and a member larger than max_member_size or
+compressed more than max_member_ratio times is rejected without being
+inflated past that size, so a ZIP bomb cannot exhaust memory.
+"""
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import zlib
+import struct
+import logging
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.utils import secure_filename
+
+logger = logging.getLogger(__name__)
+
+# Bytes copied from the request stream per write
+COPY_BLOCK_SIZE = 64 * 1024
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+
+
+class UploadError(Exception):
+    """A chunk was rejected; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class ChunkedUploadManager:
+    """
+    Tracks resumable uploads on disk and hands completed files to a grader.
+    """
+
+    def __init__(self, storage, grade_file, allowed_extensions, max_size=2 * 1024 * 1024 * 1024,
+                 grading_threads=1, max_member_size=32 * 1024 * 1024, max_member_ratio=100):
+        """
+        Args:
+            storage (StorageManager): Provides per-session directories
+            grade_file (callable): Called as grade_file(session_id, path, filename)
+                for each completed sheet; returns a JSON-serialisable result
+            allowed_extensions (set): Extensions of gradable sheets
+            max_size (int): Largest accepted upload, in bytes
+            grading_threads (int): Background threads grading completed files
+            max_member_size (int): Largest uncompressed ZIP member, in bytes
+            max_member_ratio (float): Largest uncompressed / compressed size
+                ratio of a ZIP member (scans barely compress)
+        """
+        self.storage = storage
+        self.grade_file = grade_file
+        self.allowed_extensions = allowed_extensions
+        self.max_size = max_size
+        self.grading_threads = grading_threads
+        self.max_member_size = max_member_size
+        self.max_member_ratio = max_member_ratio
+        self._executor = None
+        self._executor_pid = None
+
+    def _executor_for_process(self):
+        # Thread pools do not survive a fork, so each worker creates its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.grading_threads,
+                                                thread_name_prefix='chunked-grading')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _paths(self, upload_id):
+        session_id, _, token = upload_id.rpartition('_')
+        if not session_id or not token or secure_filename(upload_id) != upload_id:
+            raise UploadError('Unknown upload', 404)
+        directory = os.path.join(self.storage.root, session_id, 'chunked')
+        base = os.path.join(directory, token)
+        return session_id, base + '.json', base + '.part', base + '.results.jsonl'
+
+    def create(self, session_id, filename, size):
+        """
+        Start a new upload
+
+        Args:
+            session_id (str): Session the upload belongs to
+            filename (str): Original file name
+            size (int): Total size in bytes
+
+        Returns:
+            str: Upload id to send chunks to
+        """
+        filename = secure_filename(filename)
+        extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        if extension != 'zip' and extension not in self.allowed_extensions:
+            raise UploadError('Invalid file type')
+        if size <= 0 or size > self.max_size:
+            raise UploadError(f"Upload size must be between 1 and {self.max_size} bytes", 413)
+
+        upload_id = f"{session_id}_{uuid.uuid4().hex}"
+        _, meta_path, part_path, _ = self._paths(upload_id)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        open(part_path, 'wb').close()
+        self._write_meta(meta_path, {
+            'session_id': session_id,
+            'filename': filename,
+            'size': size,
+            'created': time.time(),
+            'complete': False,
+            'zip_cursor': 0,
+            'extracted': []  # Local header offsets of the ZIP members handled
+        })
+        return upload_id
+
+    def _read_meta(self, meta_path):
+        if not os.path.exists(meta_path):
+            raise UploadError('Unknown upload', 404)
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def _write_meta(self, meta_path, meta):
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def status(self, upload_id):
+        """
+        Report progress of an upload
+
+        Returns:
+            dict: Offset, size, completion flag and results graded so far
+        """
+        _, meta_path, part_path, results_path = self._paths(upload_id)
+        meta = self._read_meta(meta_path)
+        results = []
+        if os.path.exists(results_path):
+            with open(results_path) as f:
+                results = [json.loads(line) for line in f if line.strip()]
+        offset = meta['size'] if meta['complete'] else os.path.getsize(part_path)
+        return {
+            'upload_id': upload_id,
+            'filename': meta['filename'],
+            'offset': offset,
+            'size': meta['size'],
+            'complete': meta['complete'],
+            'results': results
+        }
+
+    def append(self, upload_id, offset, stream):
+        """
+        Write one chunk at the given offset
+
+        Args:
+            upload_id (str): Upload to append to
+            offset (int): Offset the client believes comes next
+            stream: File-like request body
+
+        Returns:
+            int: New offset
+        """
+        session_id, meta_path, part_path, results_path = self._paths(upload_id)
+        self._read_meta(meta_path)
+
+        with open(part_path, 'r+b') as part:
+            # Serialise writers of the same upload (possibly in other workers)
+            fcntl.flock(part, fcntl.LOCK_EX)
+            try:
+                meta = self._read_meta(meta_path)
+                if meta['complete']:
+                    raise UploadError('Upload already complete', 409)
+                current = os.fstat(part.fileno()).st_size
+                if offset != current:
+                    raise UploadError(f"Offset mismatch: expected {current}", 409)
+                part.seek(current)
+                while True:
+                    block = stream.read(COPY_BLOCK_SIZE)
+                    if not block:
+                        break
+                    if current + len(block) > meta['size']:
+                        part.truncate(offset)
+                        raise UploadError('Chunk exceeds declared upload size', 413)
+                    part.write(block)
+                    current += len(block)
+                part.flush()
+
+                if meta['filename'].lower().endswith('.zip'):
+                    self._extract_arrived_members(session_id, meta, part_path, results_path, current)
+                if current == meta['size']:
+                    self._complete(session_id, meta, part_path, results_path)
+                self._write_meta(meta_path, meta)
+            finally:
+                fcntl.flock(part, fcntl.LOCK_UN)
+        return current
+
+    def _submit(self, session_id, path, filename, results_path):
+        """Grade a completed sheet in the background and record the outcome"""
+        def _run():
+            try:
+                outcome = self.grade_file(session_id, path, filename)
+                record = {'filename': filename, 'result': outcome}
+            except Exception as e:
+                logger.error(f"Error grading uploaded file {filename}: {str(e)}")
+                record = {'filename': filename, 'error': str(e)}
+            with open(results_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+        self._executor_for_process().submit(_run)
+
+    def _is_sheet(self, name):
+        filename = secure_filename(os.path.basename(name))
+        return '.' in filename and filename.rsplit('.', 1)[-1].lower() in self.allowed_extensions
+
+    def _member_problem(self, file_size, compressed_size):
+        """Why a ZIP member of the given declared sizes is refused, or None"""
+        if file_size > self.max_member_size:
+            return f"larger than {self.max_member_size} bytes uncompressed"
+        if file_size > self.max_member_ratio * max(compressed_size, 1):
+            return f"compressed more than {self.max_member_ratio:g} times"
+        return None
+
+    def _reject_member(self, name, reason, results_path):
+        """Record a ZIP member that is not extracted"""
+        logger.warning(f"Rejected ZIP member {name}: {reason}")
+        with open(results_path, 'a') as f:
+            f.write(json.dumps({'filename': os.path.basename(name), 'error': f"Rejected: {reason}"}) + '\n')
+
+    def _save_member(self, session_id, name, data, results_path):
+        """Store one extracted ZIP member and queue it for grading"""
+        filename = secure_filename(os.path.basename(name))
+        path = self.storage.session_path(session_id, f"student_{uuid.uuid4().hex[:8]}_{filename}")
+        with open(path, 'wb') as f:
+            f.write(data)
+        self._submit(session_id, path, filename, results_path)
+
+    def _extract_arrived_members(self, session_id, meta, part_path, results_path, available):
+        """
+        Extract ZIP members whose bytes have fully arrived
+
+        Walks local file headers from the last position reached. Stops at the
+        central directory, at a member that is not complete yet, or at one
+        whose sizes are only given after its data (those are handled by
+        zipfile once the upload completes). Each member walked is recorded
+        in meta['extracted'] by its local header offset.
+        """
+        with open(part_path, 'rb') as f:
+            cursor = meta['zip_cursor']
+            while cursor + LOCAL_HEADER.size <= available:
+                f.seek(cursor)
+                (signature, _, flags, method, _, _, _, compressed_size, file_size, name_length,
+                 extra_length) = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+                if signature != LOCAL_HEADER_SIGNATURE or flags & 0x08 or compressed_size == 0xFFFFFFFF:
+                    break
+                data_start = cursor + LOCAL_HEADER.size + name_length + extra_length
+                if data_start + compressed_size > available:
+                    break
+                if method not in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+                    break
+                # Decoded as zipfile does, so result names match either way
+                name = f.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437', errors='replace')
+                meta['extracted'].append(cursor)
+                cursor = data_start + compressed_size
+                if name.endswith('/') or not self._is_sheet(name):
+                    continue
+                problem = self._member_problem(file_size, compressed_size)
+                if problem is not None:
+                    self._reject_member(name, problem, results_path)
+                    continue
+                f.seek(data_start)
+                data = f.read(compressed_size)
+                if method == zipfile.ZIP_DEFLATED:
+                    # The declared size may lie, so inflate no more than the limit
+                    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+                    data = inflater.decompress(data, self.max_member_size)
+                    if inflater.unconsumed_tail:
+                        self._reject_member(name, self._member_problem(self.max_member_size + 1, 1),
+                                            results_path)
+                        continue
+                self._save_member(session_id, name, data, results_path)
+            meta['zip_cursor'] = cursor
+
+    def _complete(self, session_id, meta, part_path, results_path):
+        """Hand a fully received upload over for grading"""
+        meta['complete'] = True
+        if meta['filename'].lower().endswith('.zip'):
+            # Inflating the remaining members can take a while, so it runs in
+            # the background rather than in the request holding the lock
+            self._executor_for_process().submit(self._extract_remaining, session_id, meta['filename'],
+                                                set(meta['extracted']), part_path, results_path)
+            return
+
+        path = self.storage.session_path(session_id, f"student_{uuid.uuid4().hex[:8]}_{meta['filename']}")
+        os.replace(part_path, path)
+        open(part_path, 'wb').close()
+        self._submit(session_id, path, meta['filename'], results_path)
+
+    def _extract_remaining(self, session_id, filename, extracted, part_path, results_path):
+        """
+        Extract the members of a completed ZIP not handled while it arrived
+
+        Args:
+            session_id (str): Session the upload belongs to
+            filename (str): Name of the ZIP
+            extracted (set): Local header offsets of the members already handled
+            part_path (str): The received ZIP
+            results_path (str): Where outcomes are recorded
+        """
+        try:
+            with zipfile.ZipFile(part_path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or info.header_offset in extracted or not self._is_sheet(info.filename):
+                        continue
+                    problem = self._member_problem(info.file_size, info.compress_size)
+                    if problem is None:
+                        # Read at most one byte past the limit in case file_size lies
+                        with archive.open(info) as member:
+                            data = member.read(self.max_member_size + 1)
+                        if len(data) > self.max_member_size:
+                            problem = self._member_problem(len(data), info.compress_size)
+                    if problem is not None:
+                        self._reject_member(info.filename, problem, results_path)
+                        continue
+                    self._save_member(session_id, info.filename, data, results_path)
+        except Exception as e:
+            logger.error(f"Error extracting uploaded ZIP {filename}: {str(e)}")
+            with open(results_path, 'a') as f:
+                f.write(json.dumps({'filename': filename, 'error': str(e)}) + '\n')
+        finally:
+            open(part_path, 'wb').close()  # Free the space; the meta records completion
@@ -0,0 +1,415 @@
+"""
+Compact, array-based export of the bubble classifier
+This module flattens the trained RandomForestClassifier and StandardScaler into
+plain NumPy arrays that can be memory-mapped and evaluated in batch without
+scikit-learn, so workers start faster and predict cheaply.
+
+Exports are versioned: each one is written to its own subdirectory and the
+CURRENT file is then switched to it with an atomic rename. Other processes
+may hold the previous arrays memory-mapped, so an exported file is never
+rewritten in place (truncating a mapped file kills its readers with SIGBUS);
+readers compare CURRENT with the version they loaded and reopen on change.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import numpy as np
+
+# Arrays written by export_compact_model(), one .npy file each
+ARRAY_NAMES = ('feature', 'threshold', 'left', 'right', 'proba', 'roots', 'scaler_mean', 'scaler_scale')
+META_FILE = 'meta.json'
+# Name of the version subdirectory in use, replaced atomically on export
+CURRENT_FILE = 'CURRENT'
+# Exports kept on disk, so a reader that just read CURRENT can still open it
+KEEP_VERSIONS = 3
+# Version committed with the code; retraining publishes alongside it (the
+# runtime versions are gitignored) and never prunes it
+SHIPPED_VERSION = 'v0'
+
+
+def file_sha1(path):
+    """
+    Hash a file so an export can be matched to the pickle it came from
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        str: Hex SHA-1 digest, or None if the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _temp_name(path):
+    """Name for a file written next to path and then renamed over it"""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def replace_file(path, data):
+    """
+    Write a file atomically: readers see the old or the new content, and an
+    old copy that is open or memory-mapped elsewhere stays intact
+
+    Args:
+        path (str): Destination file
+        data (bytes): New content
+    """
+    tmp_path = _temp_name(path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class CompactBubbleClassifier:
+    """
+    Random forest flattened into contiguous node arrays.
+    All trees share one set of arrays; leaves point to themselves so every
+    sample can be advanced in lock-step for max_depth iterations.
+    """
+
+    def __init__(self, feature, threshold, left, right, proba, roots, scaler_mean, scaler_scale, meta=None):
+        """Initialize the classifier from its node and scaler arrays"""
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.proba = proba
+        self.roots = roots
+        self.scaler_mean = scaler_mean
+        self.scaler_scale = scaler_scale
+        self.meta = meta or {}
+        # Export version this classifier was loaded from or published as
+        self.version = None
+        self.max_depth = int(self.meta.get('max_depth', len(feature)))
+
+    @classmethod
+    def from_sklearn(cls, model, scaler):
+        """
+        Flatten a fitted forest and scaler
+
+        Args:
+            model (RandomForestClassifier): Fitted forest
+            scaler (StandardScaler): Fitted feature scaler
+
+        Returns:
+            CompactBubbleClassifier: Equivalent compact classifier
+        """
+        classes = list(model.classes_)
+        filled_idx = classes.index(1) if 1 in classes else None
+
+        features, thresholds, lefts, rights, probas, roots = [], [], [], [], [], []
+        offset = 0
+        max_depth = 0
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            n = tree.node_count
+            is_leaf = tree.children_left == -1
+            node_ids = np.arange(n)
+
+            # Per-tree class proportions, as used by predict_proba
+            values = tree.value[:, 0, :]
+            totals = values.sum(axis=1)
+            totals[totals == 0] = 1
+            if filled_idx is None:
+                filled = np.zeros(n)
+            else:
+                filled = values[:, filled_idx] / totals
+
+            features.append(np.where(is_leaf, 0, tree.feature))
+            thresholds.append(tree.threshold)
+            lefts.append(np.where(is_leaf, node_ids, tree.children_left) + offset)
+            rights.append(np.where(is_leaf, node_ids, tree.children_right) + offset)
+            probas.append(filled)
+            roots.append(offset)
+            offset += n
+            max_depth = max(max_depth, tree.max_depth)
+
+        n_features = model.n_features_in_
+        mean = scaler.mean_ if getattr(scaler, 'mean_', None) is not None else np.zeros(n_features)
+        scale = scaler.scale_ if getattr(scaler, 'scale_', None) is not None else np.ones(n_features)
+
+        return cls(
+            feature=np.concatenate(features).astype(np.int32),
+            threshold=np.concatenate(thresholds).astype(np.float64),
+            left=np.concatenate(lefts).astype(np.int32),
+            right=np.concatenate(rights).astype(np.int32),
+            proba=np.concatenate(probas).astype(np.float64),
+            roots=np.array(roots, dtype=np.int32),
+            scaler_mean=np.asarray(mean, dtype=np.float64),
+            scaler_scale=np.asarray(scale, dtype=np.float64),
+            meta={'n_trees': len(roots), 'n_nodes': offset, 'n_features': int(n_features),
+                  'max_depth': int(max_depth)}
+        )
+
+    def save(self, path):
+        """
+        Write the arrays and metadata to a directory.
+        Each file is written under a temporary name and renamed into place,
+        so copies already memory-mapped by other readers are not truncated.
+
+        Args:
+            path (str): Output directory (created if missing)
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in ARRAY_NAMES:
+            target = os.path.join(path, f"{name}.npy")
+            tmp_path = _temp_name(target)
+            try:
+                with open(tmp_path, 'wb') as array_file:
+                    np.save(array_file, np.ascontiguousarray(getattr(self, name)))
+                os.replace(tmp_path, target)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        replace_file(os.path.join(path, META_FILE), json.dumps(self.meta, indent=2).encode())
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load an exported classifier
+
+        Args:
+            path (str): Directory written by save()
+            mmap (bool): Memory-map the arrays instead of reading them
+
+        Returns:
+            CompactBubbleClassifier: The loaded classifier
+        """
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in ARRAY_NAMES}
+        with open(os.path.join(path, META_FILE)) as meta_file:
+            meta = json.load(meta_file)
+        return cls(meta=meta, **arrays)
+
+    def predict_proba(self, X):
+        """
+        Probability that each sample is a filled bubble
+
+        Args:
+            X (numpy.ndarray): Raw (unscaled) feature matrix, one row per bubble
+
+        Returns:
+            numpy.ndarray: Filled-bubble probability per row
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        # Trees compare float32 features, as scikit-learn does
+        X_scaled = ((X - self.scaler_mean) / self.scaler_scale).astype(np.float32)
+
+        rows = np.arange(X_scaled.shape[0])[:, None]
+        nodes = np.broadcast_to(self.roots, (X_scaled.shape[0], len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            go_left = X_scaled[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+
+        return self.proba[nodes].mean(axis=1)
+
+    def predict(self, X):
+        """
+        Predict filled/empty labels with confidences
+
+        Args:
+            X (numpy.ndarray): Raw (unscaled) feature matrix
+
+        Returns:
+            tuple: (labels (1=filled, 0=empty), confidences) as arrays
+        """
+        filled = self.predict_proba(X)
+        labels = (filled > 0.5).astype(int)
+        return labels, np.maximum(filled, 1 - filled)
+
+
+def current_version(path):
+    """
+    Version subdirectory CURRENT points to
+
+    Args:
+        path (str): Export directory
+
+    Returns:
+        str: Version name, or None if nothing has been exported
+    """
+    try:
+        with open(os.path.join(path, CURRENT_FILE)) as current_file:
+            return current_file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish(compact, path):
+    """
+    Save a classifier as a new version and make it the current one
+
+    Args:
+        compact (CompactBubbleClassifier): Classifier to export
+        path (str): Export directory
+
+    Returns:
+        str: Name of the new version
+    """
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    # Nanosecond timestamps keep names unique and in export order
+    version = f"v{time.time_ns()}.{os.getpid()}"
+    staging = os.path.join(path, f".{version}.tmp")
+    compact.save(staging)
+    os.rename(staging, os.path.join(path, version))
+    replace_file(os.path.join(path, CURRENT_FILE), version.encode())
+    compact.version = version
+
+    # Unlinking a mapped file is safe: readers keep the old inode until they reopen
+    versions = sorted(name for name in os.listdir(path)
+                      if name.startswith('v') and name != SHIPPED_VERSION
+                      and os.path.isdir(os.path.join(path, name)))
+    for old in versions[:-KEEP_VERSIONS]:
+        if old != version:
+            shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+    return version
+
+
+def export_compact_model(model, scaler, path, source_file=None):
+    """
+    Compile a fitted forest and scaler and publish it as a new export version
+
+    Args:
+        model (RandomForestClassifier): Fitted forest
+        scaler (StandardScaler): Fitted feature scaler
+        path (str): Export directory
+        source_file (str): Pickle the export was made from, recorded by hash
+
+    Returns:
+        CompactBubbleClassifier: The exported classifier
+    """
+    compact = CompactBubbleClassifier.from_sklearn(model, scaler)
+    if source_file is not None:
+        compact.meta['source_sha1'] = file_sha1(source_file)
+    publish(compact, path)
+    return compact
+
+
+def load_current(path):
+    """
+    Load the current export version
+
+    Args:
+        path (str): Export directory
+
+    Returns:
+        CompactBubbleClassifier: The classifier, or None if nothing was exported
+    """
+    version = current_version(path)
+    if version is None:
+        return None
+    compact = CompactBubbleClassifier.load(os.path.join(path, version))
+    compact.version = version
+    return compact
+
+
+def load_if_current(path, source_file):
+    """
+    Load the current export only if it was made from the current pickle
+
+    Args:
+        path (str): Export directory
+        source_file (str): Pickled forest the export should match
+
+    Returns:
+        CompactBubbleClassifier: The classifier, or None if missing or stale
+    """
+    compact = load_current(path)
+    if compact is None:
+        return None
+    source_sha1 = file_sha1(source_file)
+    if source_sha1 is not None and compact.meta.get('source_sha1') != source_sha1:
+        return None
+    return compact
+
+
+def synthetic_features(scaler, n_samples=10000, seed=0):
+    """
+    Sample raw feature vectors around the training distribution
+
+    Args:
+        scaler (StandardScaler): Fitted scaler giving the feature mean and scale
+        n_samples (int): Number of rows to draw
+        seed (int): Random seed
+
+    Returns:
+        numpy.ndarray: Feature matrix in raw (unscaled) units
+    """
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((n_samples, len(scaler.mean_))) * scaler.scale_ + scaler.mean_
+
+
+def agreement_report(compact, model, scaler, X):
+    """
+    Compare the compact classifier against the original forest
+
+    Args:
+        compact (CompactBubbleClassifier): Exported classifier
+        model (RandomForestClassifier): Original forest
+        scaler (StandardScaler): Original scaler
+        X (numpy.ndarray): Raw feature matrix to evaluate on
+
+    Returns:
+        dict: Label agreement rate and probability differences
+    """
+    X_scaled = scaler.transform(X)
+    forest_labels = model.predict(X_scaled)
+    classes = list(model.classes_)
+    if 1 in classes:
+        forest_filled = model.predict_proba(X_scaled)[:, classes.index(1)]
+    else:
+        forest_filled = np.zeros(len(X))
+
+    compact_filled = compact.predict_proba(X)
+    compact_labels = (compact_filled > 0.5).astype(int)
+    diff = np.abs(compact_filled - forest_filled)
+
+    return {
+        'samples': int(len(X)),
+        'label_agreement': float(np.mean(compact_labels == forest_labels)),
+        'max_proba_diff': float(diff.max()) if len(diff) else 0.0,
+        'mean_proba_diff': float(diff.mean()) if len(diff) else 0.0
+    }
+
+
+# Export the pickled model for independent use
+if __name__ == "__main__":
+    import pickle
+    from ml_model import MODEL_FILE, SCALER_FILE, COMPACT_MODEL_DIR
+
+    with open(MODEL_FILE, 'rb') as model_file:
+        forest = pickle.load(model_file)
+    with open(SCALER_FILE, 'rb') as scaler_file:
+        feature_scaler = pickle.load(scaler_file)
+
+    exported = export_compact_model(forest, feature_scaler, COMPACT_MODEL_DIR, source_file=MODEL_FILE)
+    print(f"Exported {exported.meta['n_trees']} trees / {exported.meta['n_nodes']} nodes "
+          f"to {COMPACT_MODEL_DIR} as {exported.version}")
+
+    samples = synthetic_features(feature_scaler)
+    report = agreement_report(exported, forest, feature_scaler, samples)
+    print(f"Agreement with forest: {json.dumps(report)}")
+
+    start = time.perf_counter()
+    forest.predict_proba(feature_scaler.transform(samples))
+    forest_time = time.perf_counter() - start
+    start = time.perf_counter()
+    exported.predict_proba(samples)
+    compact_time = time.perf_counter() - start
+    print(f"Batch of {len(samples)}: forest {forest_time * 1000:.1f}ms, compact {compact_time * 1000:.1f}ms")
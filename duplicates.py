@@ -0,0 +1,113 @@
+"""
+Duplicate submission detection
+In webcam and realtime modes the same sheet is often captured several times.
+Each graded sheet gets a fingerprint of its marks: one bit per bubble found
+while grading, set when the bubble's share of marked pixels is above the
+midpoint between the emptiest and fullest bubble of the sheet. It is built
+from the bubble rows grading has already computed, so it costs no decode
+and no image processing of its own.
+
+Two captures of one sheet give the same bits; sheets one answer apart
+differ in two bubbles. A match is still only a candidate: a capture is
+merged with an earlier result only when the student's name is given,
+matches the earlier sheet's and the extracted answers are identical.
+Unnamed captures are never merged; they are stored and flagged as possible
+duplicates for the user to resolve.
+"""
+
+import logging
+
+import numpy as np
+
+from pipeline import bubble_region
+
+logger = logging.getLogger(__name__)
+
+# Names sent for captures without a student name (the webcam page sends 'Unknown')
+UNNAMED = ('', 'Unknown')
+
+
+def is_named(student_name):
+    """Whether a capture carries a real student name"""
+    return bool(student_name) and student_name not in UNNAMED
+
+
+def fill_fingerprint(sheet, grid_coords):
+    """
+    Fingerprint of the marks on a graded sheet
+
+    Args:
+        sheet (SheetPipeline): The sheet answers were extracted from
+        grid_coords (tuple): Grid coordinates at the sheet's resolution
+
+    Returns:
+        int: One bit per bubble (rows top to bottom, bubbles left to right),
+            or None if no bubbles were found
+    """
+    grid_region, rows = sheet.rows(grid_coords)
+    fills = []
+    for row in rows:
+        for bubble in row:
+            region = bubble_region(grid_region, bubble)
+            fills.append(np.count_nonzero(region) / region.size if region.size else 0.0)
+    if not fills:
+        return None
+    fills = np.array(fills)
+    marked = fills > (fills.min() + fills.max()) / 2
+    # A leading 1 keeps sheets with different bubble counts apart
+    return int('1' + ''.join('1' if bit else '0' for bit in marked), 2)
+
+
+class DuplicateIndex:
+    """
+    Fingerprints of the sheets graded in one session.
+    Exact matches are a dict lookup; otherwise all fingerprints are scanned,
+    which is one XOR and popcount per graded sheet.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._entries = []  # (fingerprint, result index, student name)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __sizeof__(self):
+        # Rough per-entry cost (tuple, hash int, name), for the session size estimate
+        return object.__sizeof__(self) + 120 * len(self._entries)
+
+    def add(self, fingerprint, index, student_name):
+        """Register the fingerprint of the result at results[index]"""
+        self._entries.append((fingerprint, index, student_name))
+        self._exact.setdefault(fingerprint, len(self._entries) - 1)
+
+    def find(self, fingerprint, student_name, max_distance):
+        """
+        Find an earlier sheet the capture may duplicate
+
+        Named captures are only compared with sheets of the same name;
+        unnamed ones with every sheet. A match is a candidate to confirm,
+        not proof of a duplicate.
+
+        Args:
+            fingerprint (int): Fingerprint of the new capture
+            student_name (str): Name entered for the new capture
+            max_distance (int): Largest Hamming distance still treated as a candidate
+
+        Returns:
+            tuple: (result index, Hamming distance), or (None, None)
+        """
+        def compatible(name):
+            return not is_named(student_name) or name == student_name
+
+        position = self._exact.get(fingerprint)
+        if position is not None and compatible(self._entries[position][2]):
+            return self._entries[position][1], 0
+
+        best_index, best_distance = None, None
+        for other, index, name in self._entries:
+            distance = (fingerprint ^ other).bit_count()
+            if distance <= max_distance and compatible(name) and (
+                    best_distance is None or distance < best_distance):
+                best_index, best_distance = index, distance
+        return best_index, best_distance
@@ -0,0 +1,148 @@
+"""
+Exam version identification
+A session can hold several answer keys (versions A/B/C/...). Each key gets a
+cheap fingerprint: an average hash of either the whole page (layout) or a
+configured region where the version marker is printed. Incoming sheets are
+fingerprinted the same way and routed to the nearest key before grading.
+
+Versions usually share one printed layout, so whole-page hashes cannot tell
+them apart; telling versions apart needs the marker region. A sheet is only
+routed when its nearest key is within MAX_DISTANCE bits and clearly nearer
+than the runner-up; otherwise VersionNotIdentified is raised and the client
+has to name the version.
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Side of the (square) thumbnail the hash is computed from; 16 -> 256 bits
+HASH_SIZE = 16
+# Largest distance still accepted as a match (1/8 of the bits)
+MAX_DISTANCE = HASH_SIZE * HASH_SIZE // 8
+# Bits by which the best match must beat the second best
+MIN_MARGIN = 8
+
+
+class VersionNotIdentified(ValueError):
+    """A sheet's fingerprint does not single out one exam version"""
+
+
+def next_label(existing):
+    """
+    Label for a version uploaded without one
+
+    Args:
+        existing (iterable): Labels already in use
+
+    Returns:
+        str: First unused letter from A to Z, or None if all are taken
+    """
+    used = set(existing)
+    return next((chr(code) for code in range(ord('A'), ord('Z') + 1) if chr(code) not in used), None)
+
+
+def parse_region(value):
+    """
+    Parse a marker region given as 'x,y,w,h' fractions of the page
+
+    Args:
+        value (str): Region specification, or empty for the whole page
+
+    Returns:
+        tuple: (x, y, w, h) fractions, or None for the whole page
+    """
+    if not value:
+        return None
+    region = tuple(float(v) for v in value.split(','))
+    if len(region) != 4:
+        raise ValueError(f"Marker region must be 'x,y,w,h', got {value!r}")
+    return region
+
+
+def layout_fingerprint(image_path, region=None):
+    """
+    Average hash of a sheet (or of its version-marker region)
+
+    Args:
+        image_path (str): Path to the sheet image
+        region (tuple): (x, y, w, h) fractions of the page to hash, or None
+            for the whole page
+
+    Returns:
+        bytes: Packed HASH_SIZE x HASH_SIZE bit hash
+    """
+    import cv2
+
+    # Decoded at quarter resolution; only a thumbnail is needed
+    gray = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if gray is None:
+        raise ValueError(f"Could not read image at {image_path}")
+
+    if region is not None:
+        height, width = gray.shape
+        x, y, w, h = region
+        gray = gray[int(y * height):int((y + h) * height), int(x * width):int((x + w) * width)]
+        if gray.size == 0:
+            raise ValueError(f"Marker region {region} is empty for {image_path}")
+
+    thumbnail = cv2.resize(gray, (HASH_SIZE, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    return np.packbits(thumbnail > thumbnail.mean()).tobytes()
+
+
+def hamming_distance(a, b):
+    """Number of differing bits between two packed hashes"""
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).bit_count()
+
+
+class VersionIndex:
+    """
+    Maps fingerprints to version labels.
+    Routing scans the (few) versions of one exam, independent of the number
+    of sheets.
+    """
+
+    def __init__(self):
+        self._fingerprints = []  # (label, fingerprint)
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def add(self, label, fingerprint):
+        """Register (or replace) the fingerprint of a version"""
+        self._fingerprints = [(l, f) for l, f in self._fingerprints if l != label]
+        self._fingerprints.append((label, fingerprint))
+
+    def ranked(self, fingerprint, exclude=None):
+        """Registered versions as (distance, label), nearest first, optionally without one label"""
+        return sorted((hamming_distance(fingerprint, f), l) for l, f in self._fingerprints if l != exclude)
+
+    def route(self, fingerprint, max_distance=MAX_DISTANCE, min_margin=MIN_MARGIN):
+        """
+        Find the version a sheet belongs to
+
+        Args:
+            fingerprint (bytes): Fingerprint of the incoming sheet
+            max_distance (int): Largest distance accepted as a match
+            min_margin (int): Bits by which the match must beat the runner-up
+
+        Returns:
+            tuple: (label, Hamming distance), or (None, None) if the index is empty
+
+        Raises:
+            VersionNotIdentified: No version is near enough, or two are about as near
+        """
+        ranked = self.ranked(fingerprint)
+        if not ranked:
+            return None, None
+        distance, label = ranked[0]
+        if distance > max_distance:
+            raise VersionNotIdentified(
+                f"Sheet does not match any exam version (nearest is {label}, {distance} bits differ)")
+        if len(ranked) > 1 and ranked[1][0] - distance < min_margin:
+            raise VersionNotIdentified(
+                f"Sheet matches exam versions {label} and {ranked[1][1]} about equally "
+                f"({distance} and {ranked[1][0]} bits differ)")
+        return label, distance
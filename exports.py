@@ -0,0 +1,222 @@
+"""
+Streaming result exports
+Rows are generated one result at a time from the session and written out in
+small batches, so memory use does not grow with the number of students.
+Responses export one row per student with a column per question; item
+statistics export one row per question (per exam version) with difficulty,
+discrimination and choice counts. Both are available as CSV, and as Parquet
+or Arrow IPC when pyarrow is installed.
+"""
+
+import io
+import csv
+import math
+
+from session_store import NO_ANSWER, decode_answer
+
+# Rows written per CSV chunk / columnar record batch
+BATCH_SIZE = 512
+
+FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream'
+}
+
+# Display strings for every answer byte; blank for unanswered questions
+ANSWER_LABELS = [''] + [decode_answer(code) for code in range(1, 256)]
+
+# Columns are (name, type) pairs; type is 'str', 'int' or 'float'
+SUMMARY_COLUMNS = [('Student Name', 'str'), ('Score', 'int'), ('Total', 'int'), ('Percentage', 'float'),
+                   ('Timestamp', 'str'), ('Detection Mode', 'str'), ('Version', 'str')]
+
+
+def columnar_available():
+    """Whether pyarrow is installed for Parquet/Arrow exports"""
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def response_columns(n_questions):
+    """Columns of the responses export"""
+    return SUMMARY_COLUMNS + [(f"Q{i + 1}", 'str') for i in range(n_questions)]
+
+
+def iter_response_rows(results, n_questions, percent_sign=False):
+    """
+    Yield one row per graded sheet
+
+    Args:
+        results (list): CompactResult records of a session
+        n_questions (int): Number of per-question columns
+        percent_sign (bool): Give Percentage as an "85.00%" string, as the
+            legacy CSV export does, instead of a number
+
+    Yields:
+        list: Summary values followed by the student's answer to each question
+    """
+    # Only results present when the export started; later appends are not included
+    for i in range(len(results)):
+        r = results[i]
+        answers = [ANSWER_LABELS[code] for code in r.answer_codes]
+        answers += [''] * (n_questions - len(answers))
+        percentage = f"{r.percentage:.2f}%" if percent_sign else round(r.percentage, 2)
+        yield [r.student_name, r.score, r.total, percentage, r.timestamp, r.mode, r.version or ''] + answers
+
+
+def item_statistics(results):
+    """
+    Per-question statistics, computed in one pass over the results
+
+    For each exam version and question: number of responses, omissions,
+    proportion correct (difficulty), point-biserial correlation between
+    answering correctly and total score (discrimination), and how often each
+    choice was picked.
+
+    Args:
+        results (list): CompactResult records of a session
+
+    Returns:
+        tuple: (columns, list of rows)
+    """
+    versions = {}
+    max_choice = 0
+    for i in range(len(results)):
+        r = results[i]
+        stats = versions.get(r.version)
+        if stats is None:
+            stats = versions[r.version] = {
+                'key': r.key_codes, 'n': 0, 'score_sum': 0.0, 'score_sq_sum': 0.0,
+                'correct': [0] * len(r.key_codes), 'correct_score_sum': [0.0] * len(r.key_codes),
+                'choices': [{} for _ in r.key_codes]
+            }
+        stats['n'] += 1
+        stats['score_sum'] += r.score
+        stats['score_sq_sum'] += r.score * r.score
+        for q, (given, expected) in enumerate(zip(r.answer_codes, stats['key'])):
+            stats['choices'][q][given] = stats['choices'][q].get(given, 0) + 1
+            max_choice = max(max_choice, given)
+            if given == expected and given != NO_ANSWER:
+                stats['correct'][q] += 1
+                stats['correct_score_sum'][q] += r.score
+
+    choice_codes = list(range(1, max_choice + 1))
+    columns = ([('Version', 'str'), ('Question', 'int'), ('Correct Answer', 'str'), ('Responses', 'int'),
+                ('Omitted', 'int'), ('Difficulty', 'float'), ('Discrimination', 'float')]
+               + [(f"Chose {ANSWER_LABELS[code]}", 'int') for code in choice_codes])
+    rows = []
+    for version, stats in versions.items():
+        n = stats['n']
+        mean = stats['score_sum'] / n
+        std = math.sqrt(max(stats['score_sq_sum'] / n - mean * mean, 0.0))
+        for q, expected in enumerate(stats['key']):
+            n_correct = stats['correct'][q]
+            p = n_correct / n
+            discrimination = None
+            if std > 0 and 0 < n_correct < n:
+                mean_correct = stats['correct_score_sum'][q] / n_correct
+                mean_wrong = (stats['score_sum'] - stats['correct_score_sum'][q]) / (n - n_correct)
+                discrimination = round((mean_correct - mean_wrong) / std * math.sqrt(p * (1 - p)), 4)
+            choices = stats['choices'][q]
+            omitted = choices.get(NO_ANSWER, 0)
+            rows.append([version or '', q + 1, ANSWER_LABELS[expected], n - omitted, omitted, round(p, 4),
+                         discrimination] + [choices.get(code, 0) for code in choice_codes])
+    return columns, rows
+
+
+def iter_csv(columns, rows):
+    """
+    Encode rows as CSV text in batches
+
+    Yields:
+        str: Chunks of CSV text, starting with the header
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+    for i, row in enumerate(rows, 1):
+        writer.writerow(['' if value is None else value for value in row])
+        if i % BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands out what was written since the last drain"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_columnar(columns, rows, fmt):
+    """
+    Encode rows as Parquet or an Arrow IPC stream in record batches
+
+    Empty strings and None become nulls.
+
+    Args:
+        columns (list): (name, type) pairs
+        rows (iterable): Row lists
+        fmt (str): 'parquet' or 'arrow'
+
+    Yields:
+        bytes: Encoded chunks
+    """
+    import pyarrow as pa
+
+    types = {'str': pa.string(), 'int': pa.int64(), 'float': pa.float64()}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+
+    sink = _ChunkSink()
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema)
+        write = writer.write_table
+        wrap = pa.Table.from_batches
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+        write = writer.write_batch
+        wrap = None
+
+    def flush(batch_rows):
+        arrays = []
+        for j, field in enumerate(schema):
+            values = [None if row[j] == '' else row[j] for row in batch_rows]
+            arrays.append(pa.array(values, type=field.type))
+        batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+        write(wrap([batch]) if wrap else batch)
+
+    batch_rows = []
+    for row in rows:
+        batch_rows.append(row)
+        if len(batch_rows) == BATCH_SIZE:
+            flush(batch_rows)
+            batch_rows = []
+            yield sink.drain()
+    if batch_rows:
+        flush(batch_rows)
+    writer.close()
+    yield sink.drain()
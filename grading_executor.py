@@ -0,0 +1,148 @@
+"""
+In-process grading executor
+Decoding, preprocessing and answer extraction run on a small thread pool
+shared by all requests of a worker process. The heavy OpenCV calls release
+the GIL, so while one sheet is being decoded or thresholded another can run
+its Python-side bubble classification: a single worker keeps several cores
+busy without the memory cost of more worker processes.
+
+The number of sheets queued or in progress is bounded. When the queue is
+full, a submission waits up to wait_timeout seconds for a slot and then
+fails with GradingBusy, which the app answers with 503 so clients back off
+instead of piling up requests.
+"""
+
+import os
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Pool width when GRADING_THREADS is not set, shared by the app and the
+# gunicorn config: one thread per core up to 4, and at least 2 so that one
+# sheet's Python-side work overlaps another's decoding even on one core
+DEFAULT_THREADS = max(2, min(4, os.cpu_count() or 1))
+
+
+class GradingBusy(Exception):
+    """The grading queue stayed full for longer than the wait timeout"""
+
+
+class GradingExecutor:
+    """
+    Bounded thread pool for grading work.
+    """
+
+    def __init__(self, threads=2, max_pending=8, wait_timeout=5.0):
+        """
+        Args:
+            threads (int): Pool threads; 0 runs work inline on the calling thread
+            max_pending (int): Sheets queued or in progress before submissions wait
+            wait_timeout (float): Seconds a submission waits for a free slot
+        """
+        self.threads = threads
+        self.max_pending = max(max_pending, 1)
+        self.wait_timeout = wait_timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def _executor_for_process(self):
+        # Thread pools do not survive a fork, so each worker creates its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='grading')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue a grading call
+
+        Returns:
+            concurrent.futures.Future: Result of fn(*args, **kwargs)
+
+        Raises:
+            GradingBusy: No slot became free within wait_timeout
+        """
+        return self._submit(fn, args, kwargs, self.wait_timeout)
+
+    def submit_waiting(self, fn, *args, **kwargs):
+        """
+        Queue a grading call, waiting as long as it takes for a free slot.
+        For background work, which has no client to answer with 503.
+
+        Returns:
+            concurrent.futures.Future: Result of fn(*args, **kwargs)
+        """
+        return self._submit(fn, args, kwargs, None)
+
+    def _submit(self, fn, args, kwargs, timeout):
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self._rejected += 1
+            raise GradingBusy(f"Grading queue full ({self.max_pending} sheets pending)")
+        with self._lock:
+            self._pending += 1
+
+        if self.threads <= 0:
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self._release()
+            return future
+
+        try:
+            future = self._executor_for_process().submit(fn, *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        """Run a grading call on the pool and wait for its result"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def map(self, fn, items, window=None):
+        """
+        Grade several items, keeping up to window of them in flight
+
+        Args:
+            fn (callable): Called with each item
+            items (iterable): Work items
+            window (int): Items submitted ahead of the one being consumed
+                (default: the number of pool threads)
+
+        Yields:
+            tuple: (item, Future), in the order of items
+        """
+        window = max(window or self.threads, 1)
+        in_flight = deque()
+        for item in items:
+            in_flight.append((item, self.submit(fn, item)))
+            if len(in_flight) >= window:
+                yield in_flight.popleft()
+        while in_flight:
+            yield in_flight.popleft()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'threads': self.threads,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'rejected': self._rejected
+            }
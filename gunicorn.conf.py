@@ -0,0 +1,90 @@
+"""
+Gunicorn configuration for production deployments
+Run with: gunicorn --config gunicorn.conf.py main:app
+
+The app and the bubble detector are loaded once in the master process and
+shared copy-on-write with the forked workers. Each worker is limited to a
+small number of OpenCV/BLAS threads so that workers x threads does not
+oversubscribe the machine.
+
+Sessions, exam versions and duplicate fingerprints are kept in each worker's
+memory, so a session only exists in the worker that created it. The default
+is therefore a single worker that scales with request threads and the
+grading thread pool; more workers are only safe behind a load balancer that
+pins each session to one worker.
+
+Environment variables:
+    PORT                   Port to bind (default 5000)
+    GUNICORN_WORKERS       Worker processes (default 1, see above)
+    GUNICORN_THREADS       Request threads per worker (default: twice the
+                           CPU cores, at least 4)
+    GUNICORN_PRELOAD       Set to 0 to load the app in each worker instead
+                           (needed for --reload during development)
+    WORKER_CV_THREADS      OpenCV/BLAS threads per worker
+                           (default: cores // workers, at least 1)
+    GRADING_THREADS        Grading executor threads per worker (default:
+                           one per core, 2 to 4, as in app.py); OpenCV's own
+                           pool is then shrunk so the two together fit the
+                           worker's cores
+
+To compare thread counts on this machine, run
+    python benchmark_workers.py --threads 1 4 8
+which starts gunicorn with each combination and reports throughput and
+latency for a fixed grading workload (see benchmark_workers.py).
+"""
+
+import gc
+import multiprocessing
+import os
+
+from grading_executor import DEFAULT_THREADS
+
+CORES = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+# Request threads mostly wait on the grading pool, so there are more of them than cores
+threads = int(os.environ.get('GUNICORN_THREADS', max(4, 2 * CORES)))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+reuse_port = True
+# Answer-key uploads retrain the model synchronously
+timeout = 120
+
+WORKER_CV_THREADS = int(os.environ.get('WORKER_CV_THREADS', max(1, CORES // max(workers, 1))))
+
+# BLAS/OpenMP pools are sized when numpy is first imported, so these must be
+# set before the app is preloaded; forked workers inherit them
+for _var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+    os.environ.setdefault(_var, str(WORKER_CV_THREADS))
+
+# The grading executor provides the worker's parallelism across sheets; the
+# app reads the same variable with the same default
+GRADING_THREADS = int(os.environ.get('GRADING_THREADS', DEFAULT_THREADS))
+CV_THREADS_PER_CALL = max(1, WORKER_CV_THREADS // max(GRADING_THREADS, 1))
+
+if preload_app:
+    # Warm up synchronously in the master below: a background warm-up thread
+    # would not survive the fork and could leave its lock held in workers
+    os.environ.setdefault('WARM_UP_ON_START', '0')
+
+
+def on_starting(server):
+    """Load the grading engine in the master before workers are forked"""
+    if not preload_app:
+        return
+    from mcq_processor import warm_up
+    warm_up()
+    # Move everything loaded so far out of the GC's tracked generations so
+    # collections in the workers do not touch (and copy) the shared pages
+    gc.freeze()
+    server.log.info(f"Preloaded grading engine; {workers} workers x {threads} threads, "
+                    f"{GRADING_THREADS} grading threads x {CV_THREADS_PER_CALL} OpenCV threads per worker")
+    if workers > 1:
+        server.log.warning(f"{workers} workers: sessions are per worker, so requests for a session "
+                           f"must be routed to the worker that created it")
+
+
+def post_fork(server, worker):
+    """Pin OpenCV's thread pool in each worker"""
+    import cv2
+    cv2.setNumThreads(CV_THREADS_PER_CALL)
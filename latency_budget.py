@@ -0,0 +1,204 @@
+"""
+Latency-budgeted grading
+When a request carries a latency budget (webcam captures by default), the
+grading pipeline picks the most accurate tier whose expected cost still fits:
+
+    full        full-resolution decode, ML bubble classification
+    fill_ratio  half-resolution decode, pure fill-ratio decision
+
+The half-resolution tier scales the layout's preprocessing settings (blur
+and threshold kernels, bubble area) to the smaller image. The classifier is
+trained on full-resolution bubble crops, so it is not used at half
+resolution. Answers from any tier but full are marked as degraded in the
+result.
+
+Training data is only collected on the full tier and only if the remaining
+budget covers the expected training time. Expected costs are moving averages
+of the times observed in this process. The first samples of each stage
+(imports, model load, first-call setup) and samples taken before the engine
+is warm are not counted, and an estimate nobody has refreshed for a while is
+dropped, so a tier that was slow once is measured again rather than being
+skipped for good. A tier skipped for probe_every requests in a row is also
+tried once more.
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from mcq_processor import engine_status, extract_answers
+from pipeline import DEFAULT_PARAMS, load_sheet
+
+logger = logging.getLogger(__name__)
+
+# Tiers from most to least accurate, with (decode reduction, answer method)
+TIERS = (
+    ('full', 1, 'ml'),
+    ('fill_ratio', 2, 'fill_ratio')
+)
+
+
+class StageTimings:
+    """Exponentially weighted moving averages of stage durations, in ms"""
+
+    def __init__(self, alpha=0.2, warmup_samples=1, max_age=120.0, probe_every=20):
+        """
+        Args:
+            alpha (float): Weight of the newest sample
+            warmup_samples (int): Samples discarded per stage before averaging
+            max_age (float): Seconds after which an unrefreshed estimate is dropped
+            probe_every (int): Consecutive skips of a stage after which it is tried again
+        """
+        self.alpha = alpha
+        self.warmup_samples = warmup_samples
+        self.max_age = max_age
+        self.probe_every = probe_every
+        self._averages = {}
+        self._updated = {}
+        self._samples = {}
+        self._skips = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, elapsed_ms):
+        with self._lock:
+            self._samples[stage] = self._samples.get(stage, 0) + 1
+            self._skips.pop(stage, None)
+            if self._samples[stage] <= self.warmup_samples:
+                return
+            previous = self.estimate(stage)
+            self._averages[stage] = elapsed_ms if previous is None else (
+                self.alpha * elapsed_ms + (1 - self.alpha) * previous)
+            self._updated[stage] = time.monotonic()
+
+    def estimate(self, stage):
+        """Expected duration of a stage, or None if it was never observed or the estimate is stale"""
+        updated = self._updated.get(stage)
+        if updated is None or time.monotonic() - updated > self.max_age:
+            return None
+        return self._averages.get(stage)
+
+    def skipped(self, stage):
+        """
+        Note that a stage was passed over for being too slow
+
+        Returns:
+            bool: True if it has been skipped probe_every times in a row and
+                should be tried again to refresh its estimate
+        """
+        with self._lock:
+            self._skips[stage] = self._skips.get(stage, 0) + 1
+            if self._skips[stage] < self.probe_every:
+                return False
+            self._skips[stage] = 0
+            return True
+
+    @contextmanager
+    def measure(self, stage, record=True):
+        """Time a block and record it under stage (unless record is False)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if record:
+                self.record(stage, (time.perf_counter() - start) * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: self.estimate(stage) for stage in self._averages}
+
+
+# Shared by all requests in this process
+stage_timings = StageTimings()
+
+
+class LatencyBudget:
+    """Time allowance for one request, counted from its creation"""
+
+    def __init__(self, budget_ms):
+        self.budget_ms = budget_ms
+        self._start = time.perf_counter()
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._start) * 1000
+
+    def remaining_ms(self):
+        return self.budget_ms - self.elapsed_ms()
+
+    def fits(self, estimate_ms):
+        """Whether a stage expected to take estimate_ms fits (unknown costs are assumed to fit)"""
+        return estimate_ms is None or estimate_ms <= self.remaining_ms()
+
+
+def grade_sheet(image_path, grid_coords, budget=None, params=None):
+    """
+    Extract a sheet's answers using the best tier the budget allows
+
+    Args:
+        image_path (str): Path to the sheet image
+        grid_coords (tuple): Grid coordinates at full resolution
+        budget (LatencyBudget): Time allowance, or None to always use the full tier
+        params (PreprocessParams): Layout's preprocessing settings, or None
+
+    Returns:
+        dict: sheet (SheetPipeline at the tier's resolution, holding the
+            bubbles found, for collect_training_data), answers,
+            tier, degraded (True unless the full tier was used),
+            confidence (mean per-answer confidence), grid_coords
+            (scaled to the tier's resolution), bubbles (question, choice,
+            x, y, w, h, selected rows in full-resolution page coordinates)
+            and image_size (full-resolution height, width)
+    """
+    tier, reduction, method = TIERS[0]
+    if budget is not None:
+        for tier, reduction, method in TIERS:
+            if budget.fits(stage_timings.estimate(tier)) or stage_timings.skipped(tier):
+                break
+        # If nothing fits, the last (cheapest) tier is used
+
+    # Samples taken while the engine is still loading say nothing about steady state
+    warm = engine_status()['state'] == 'ready'
+    with stage_timings.measure(tier, record=warm):
+        sheet = load_sheet(image_path, reduction, (params or DEFAULT_PARAMS).scaled(reduction))
+        scaled_coords = tuple(v // reduction for v in grid_coords)
+        bubble_log = []
+        answers, confidences = extract_answers(sheet, scaled_coords, method=method, return_confidence=True,
+                                               bubble_log=bubble_log)
+
+    if tier != TIERS[0][0]:
+        logger.info(f"Graded with '{tier}' tier to stay within {budget.budget_ms:.0f}ms budget")
+
+    # Map bubble positions back to full-resolution page coordinates
+    bubbles = np.array(bubble_log, dtype=np.int32).reshape(-1, 7)
+    bubbles[:, 2] = (bubbles[:, 2] + scaled_coords[0]) * reduction
+    bubbles[:, 3] = (bubbles[:, 3] + scaled_coords[1]) * reduction
+    bubbles[:, 4:6] *= reduction
+
+    return {
+        'sheet': sheet,
+        'answers': answers,
+        'tier': tier,
+        'degraded': tier != TIERS[0][0],
+        'confidence': sum(confidences) / len(confidences) if confidences else 0.0,
+        'grid_coords': scaled_coords,
+        'bubbles': bubbles,
+        'image_size': (sheet.shape[0] * reduction, sheet.shape[1] * reduction)
+    }
+
+
+def training_allowed(outcome, budget=None):
+    """
+    Whether training data may be collected after grading
+
+    Args:
+        outcome (dict): Result of grade_sheet
+        budget (LatencyBudget): Time allowance, or None
+
+    Returns:
+        bool: True on the full tier when the expected training time fits
+    """
+    if outcome['tier'] != TIERS[0][0]:
+        return False
+    return budget is None or budget.fits(stage_timings.estimate('training'))
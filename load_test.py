@@ -0,0 +1,445 @@
+"""
+Load test for the grading endpoints
+Creates sessions through /upload-answer-key, then sends a mix of
+/upload-student-sheet and /process-webcam-image requests at a fixed client
+concurrency and, optionally, a fixed arrival rate. Reports throughput,
+latency percentiles and error rates per endpoint and saves them as JSON so
+runs can be compared.
+
+Usage:
+    python load_test.py --url http://127.0.0.1:5000 --requests 500 \\
+        --concurrency 16 --rate 20 --mix upload-student-sheet=3,process-webcam-image=1
+    python load_test.py --answer-key key.jpg --sheets a.jpg b.jpg --duration 60
+    python load_test.py --compare load_test_results/run1.json load_test_results/run2.json
+
+Without --answer-key/--sheets, synthetic sheets are generated. With --rate,
+requests are scheduled at fixed times and latency is measured from the
+scheduled time, so a server that falls behind shows up as growing latency
+rather than as a lower request rate. Each request uses a distinct student
+name, so webcam duplicate detection does not short-circuit grading.
+
+Only a JSON result counts as a success: redirects (the app's answer to a
+failed form post) and HTML pages are errors. Synthetic sheets differ from
+the key in a known number of answers, and a response with any other score
+is counted as a 'wrong-score' error, labelled with the grading tier that
+produced it. Most of them score at least 70%, so the retraining path runs
+as it does in use.
+
+Note that uploading an answer key retrains the model under static/models,
+so point this at a scratch checkout if the shipped model must not change.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+ENDPOINTS = {
+    'upload-student-sheet': 'studentSheet',
+    'process-webcam-image': 'webcamImage'
+}
+RESULTS_DIR = 'load_test_results'
+
+
+def encode_multipart(fields, files):
+    """
+    Encode form fields and files as multipart/form-data
+
+    Args:
+        fields (dict): Form field names and values
+        files (dict): Field name -> (filename, bytes)
+
+    Returns:
+        tuple: (body bytes, content type header)
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Return redirects as HTTPErrors; the app answers failed form posts with a 302"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+opener = urllib.request.build_opener(NoRedirect)
+
+
+def post_form(url, fields, files, timeout=120):
+    """
+    POST a multipart form; redirects are not followed
+
+    Returns:
+        tuple: (HTTP status, response body bytes); status 0 for connection errors
+    """
+    body, content_type = encode_multipart(fields, files)
+    req = urllib.request.Request(url, data=body, headers={'Content-Type': content_type})
+    try:
+        with opener.open(req, timeout=timeout) as resp:
+            return resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except (urllib.error.URLError, ConnectionError, TimeoutError) as e:
+        return 0, str(e).encode()
+
+
+def check_response(status, body, expected_score=None):
+    """
+    Outcome of a grading request
+
+    Args:
+        status (int): HTTP status
+        body (bytes): Response body
+        expected_score (int): Score the sheet should get, or None if unknown
+
+    Returns:
+        int or str: 200 for a JSON result with the expected score; otherwise
+            the HTTP status, 'non-json' or 'wrong-score:<tier>', counted as
+            an error
+    """
+    if status != 200:
+        return status
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return 'non-json'
+    if not isinstance(payload, dict) or 'error' in payload:
+        return 'non-json'
+    if expected_score is not None and payload.get('score') != expected_score:
+        return f"wrong-score:{payload.get('tier')}"
+    return 200
+
+
+def wait_until_ready(base_url, timeout=60):
+    """Poll /ready until the grading engine reports warm"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"{base_url}/ready", timeout=2) as resp:
+                if resp.status == 200:
+                    return True
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.25)
+    return False
+
+
+def synthetic_sheet(answers, choices=4, seed=None):
+    """
+    Draw a bubble sheet laid out like the printed template: an A4 page at
+    scanner resolution with a frame around the answer grid, column letters
+    above it, question numbers beside it and rows of touching, thinly
+    outlined bubbles; a chosen bubble is covered with a dark pen mark
+
+    The grader groups bubbles into rows by height alone, so all questions
+    are in one column. Each bubble is found as the hole inside its outline
+    (the touching outlines form one long contour that is not taken as a
+    bubble), and the labels sit outside the frame so that no glyph is taken
+    for a bubble. A mark slightly larger than the outline leaves the largest
+    hole in its row, which is what the area fallback picks when the model
+    finds no filled bubble.
+
+    Args:
+        answers (list): Choice index to fill for each question (None to leave blank)
+        choices (int): Bubbles per question
+        seed (int): Seed for the scanner-like noise
+
+    Returns:
+        bytes: JPEG image
+    """
+    import cv2
+
+    page_width, page_height = 1904, 2766
+    radius, outline = 32, 3
+    # Bubbles must stay below 1/1000 of the grid area to be detected
+    left, top, right, bottom = 212, 420, 1692, 2660
+    row_height = (bottom - top - 120) // max(len(answers), 1)
+    first_x = (left + right) // 2 - choices * radius
+    first_y = top + 60
+    page = np.full((page_height, page_width), 245, dtype=np.uint8)
+
+    # Grid frame; detect_grid takes the largest rectangle on the page
+    cv2.rectangle(page, (left, top), (right, bottom), 0, 6)
+    for c in range(choices):
+        cx = first_x + (2 * c + 1) * radius
+        cv2.putText(page, chr(ord('A') + c), (cx - 14, top - 30), cv2.FONT_HERSHEY_SIMPLEX, 1.2, 0, 3)
+    for q, answer in enumerate(answers):
+        cy = first_y + q * row_height + row_height // 2
+        cv2.putText(page, str(q + 1), (left - 110, cy + 16), cv2.FONT_HERSHEY_SIMPLEX, 1.4, 0, 3)
+        for c in range(choices):
+            center = (first_x + (2 * c + 1) * radius, cy)
+            cv2.circle(page, center, radius - outline // 2, 0, outline, lineType=cv2.LINE_AA)
+        if answer is not None:
+            center = (first_x + (2 * answer + 1) * radius, cy)
+            cv2.circle(page, center, radius + 3, 25, -1, lineType=cv2.LINE_AA)
+
+    noise = np.random.default_rng(seed).normal(0, 6, page.shape)
+    page = np.clip(page + noise, 0, 255).astype(np.uint8)
+    ok, encoded = cv2.imencode('.jpg', page, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return encoded.tobytes()
+
+
+def load_images(args):
+    """
+    Answer key and student sheets to send
+
+    Returns:
+        tuple: (key, sheets) where key is a (filename, bytes) pair and sheets
+            a list of (filename, bytes, expected score or None)
+    """
+    if args.answer_key:
+        with open(args.answer_key, 'rb') as f:
+            key = (os.path.basename(args.answer_key), f.read())
+        key_answers = None
+    else:
+        rng = np.random.default_rng(0)
+        key_answers = [int(a) for a in rng.integers(0, 4, args.questions)]
+        key = ('synthetic_key.jpg', synthetic_sheet(key_answers, seed=0))
+
+    if args.sheets:
+        sheets = []
+        for path in args.sheets:
+            with open(path, 'rb') as f:
+                sheets.append((os.path.basename(path), f.read(), None))
+    elif key_answers is None:
+        raise SystemExit("Synthetic sheets need the synthetic answer key; pass --sheets with --answer-key")
+    else:
+        # Up to 30% of the answers differ from the key, so most sheets score
+        # at least 70% and also exercise the retraining path
+        rng = np.random.default_rng(1)
+        sheets = []
+        for i in range(args.synthetic_sheets):
+            answers = list(key_answers)
+            wrong = rng.choice(args.questions, size=i % (int(args.questions * 0.3) + 1), replace=False)
+            for q in wrong:
+                answers[q] = (answers[q] + int(rng.integers(1, 4))) % 4
+            sheets.append((f'synthetic_{i}.jpg', synthetic_sheet(answers, seed=i + 1), args.questions - len(wrong)))
+    return key, sheets
+
+
+def parse_mix(value):
+    """Parse 'endpoint=weight,...' into a repeating endpoint sequence"""
+    weights = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint {name!r}, expected one of {list(ENDPOINTS)}")
+        weights[name] = int(weight or 1)
+    return [name for name, weight in weights.items() for _ in range(weight)]
+
+
+def summarize(samples, elapsed):
+    """
+    Throughput, latency percentiles and errors for a list of samples
+
+    Args:
+        samples (list): (outcome, latency seconds) pairs; an outcome other
+            than 200 is an error (see check_response)
+        elapsed (float): Wall-clock duration of the run
+
+    Returns:
+        dict: Summary statistics (latencies in ms)
+    """
+    if not samples:
+        return {'requests': 0}
+    statuses = [status for status, _ in samples]
+    ok = np.array([latency for status, latency in samples if status == 200]) * 1000
+    errors = {}
+    for status in statuses:
+        if status != 200:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    summary = {
+        'requests': len(samples),
+        'errors': sum(errors.values()),
+        'error_rate': sum(errors.values()) / len(samples),
+        'errors_by_status': errors,
+        'throughput_rps': len(ok) / elapsed if elapsed > 0 else 0.0
+    }
+    if len(ok):
+        summary.update({
+            'mean_ms': float(ok.mean()),
+            'p50_ms': float(np.percentile(ok, 50)),
+            'p90_ms': float(np.percentile(ok, 90)),
+            'p95_ms': float(np.percentile(ok, 95)),
+            'p99_ms': float(np.percentile(ok, 99)),
+            'max_ms': float(ok.max())
+        })
+    return summary
+
+
+def create_sessions(base_url, key, count):
+    """Upload the answer key count times; returns the session ids"""
+    session_ids = []
+    for _ in range(count):
+        start = time.perf_counter()
+        status, body = post_form(f"{base_url}/upload-answer-key", {}, {'answerKey': key})
+        if status != 200:
+            raise RuntimeError(f"Answer key upload failed with HTTP {status}: {body[:200]!r}")
+        session_ids.append(json.loads(body)['session_id'])
+        print(f"Created session {session_ids[-1]} in {(time.perf_counter() - start) * 1000:.0f}ms")
+    return session_ids
+
+
+def run_load(base_url, session_ids, sheets, mix, requests=None, duration=None, concurrency=8, rate=None):
+    """
+    Send the request mix and collect timings
+
+    Args:
+        base_url (str): Server to test
+        session_ids (list): Sessions to spread requests over
+        sheets (list): (filename, bytes, expected score or None) sheets to
+            send, in rotation
+        mix (list): Endpoint names, repeated in order (see parse_mix)
+        requests (int): Stop after this many requests
+        duration (float): Or stop after this many seconds
+        concurrency (int): Requests in flight at most
+        rate (float): Requests per second to schedule, or None to send as
+            fast as the concurrency allows
+
+    Returns:
+        dict: Per-endpoint summaries and an 'all' summary
+    """
+    samples = {name: [] for name in set(mix)}
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def send(i, scheduled):
+        endpoint = mix[i % len(mix)]
+        filename, data, expected_score = sheets[i % len(sheets)]
+        fields = {'sessionId': session_ids[i % len(session_ids)], 'studentName': f"Load {i}"}
+        if endpoint == 'upload-student-sheet':
+            fields['mode'] = 'manual'
+        status, body = post_form(f"{base_url}/{endpoint}", fields, {ENDPOINTS[endpoint]: (filename, data)})
+        outcome = check_response(status, body, expected_score)
+        with lock:
+            samples[endpoint].append((outcome, time.perf_counter() - scheduled))
+
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # Submissions are throttled to the concurrency when there is no rate
+        slots = threading.BoundedSemaphore(concurrency) if not rate else None
+        while True:
+            i = next(counter)
+            if requests is not None and i >= requests:
+                break
+            if rate:
+                scheduled = start + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                slots.acquire()
+                scheduled = time.perf_counter()
+            if deadline and time.perf_counter() >= deadline:
+                if slots:
+                    slots.release()
+                break
+            future = pool.submit(send, i, scheduled)
+            if slots:
+                future.add_done_callback(lambda _: slots.release())
+    elapsed = time.perf_counter() - start
+
+    report = {name: summarize(endpoint_samples, elapsed) for name, endpoint_samples in samples.items()}
+    report['all'] = summarize([s for endpoint_samples in samples.values() for s in endpoint_samples], elapsed)
+    report['elapsed_s'] = elapsed
+    return report
+
+
+def print_report(report):
+    print(f"{'endpoint':<24} {'reqs':>6} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, s in report.items():
+        if not isinstance(s, dict) or not s.get('requests'):
+            continue
+        print(f"{name:<24} {s['requests']:>6} {s['throughput_rps']:>7.2f} {s.get('p50_ms', 0):>8.1f} "
+              f"{s.get('p95_ms', 0):>8.1f} {s.get('p99_ms', 0):>8.1f} {s['error_rate']:>7.1%}")
+
+
+def compare(old_path, new_path):
+    """Print throughput and latency changes between two saved runs"""
+    with open(old_path) as f:
+        old = json.load(f)['results']
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    print(f"{'endpoint':<24} {'metric':<15} {'before':>10} {'after':>10} {'change':>8}")
+    for name in new:
+        if not isinstance(new[name], dict) or name not in old:
+            continue
+        for metric in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'error_rate'):
+            before, after = old[name].get(metric), new[name].get(metric)
+            if before is None or after is None:
+                continue
+            change = f"{(after - before) / before:+.1%}" if before else '-'
+            print(f"{name:<24} {metric:<15} {before:>10.2f} {after:>10.2f} {change:>8}")
+
+
+def save_report(report, args, path=None):
+    """Write a run's configuration and results as JSON; returns the path"""
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        label = f"_{args.label}" if args.label else ''
+        path = os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}{label}.json")
+    config = {k: v for k, v in vars(args).items() if k not in ('compare', 'output')}
+    with open(path, 'w') as f:
+        json.dump({'config': config, 'results': report}, f, indent=2)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='Server to test')
+    parser.add_argument('--answer-key', help='Answer key image (default: synthetic)')
+    parser.add_argument('--sheets', nargs='+', help='Student sheet images (default: synthetic)')
+    parser.add_argument('--questions', type=int, default=20, help='Questions on synthetic sheets')
+    parser.add_argument('--synthetic-sheets', type=int, default=8, help='Distinct synthetic sheets')
+    parser.add_argument('--sessions', type=int, default=1, help='Sessions to spread requests over')
+    parser.add_argument('--mix', default='upload-student-sheet=1,process-webcam-image=1',
+                        help="Endpoint weights, e.g. 'upload-student-sheet=3,process-webcam-image=1'")
+    parser.add_argument('--requests', type=int, help='Total requests (default 200 unless --duration)')
+    parser.add_argument('--duration', type=float, help='Run for this many seconds')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, help='Requests per second (default: as fast as possible)')
+    parser.add_argument('--label', help='Added to the saved result file name')
+    parser.add_argument('--output', help=f'Result file (default: {RESULTS_DIR}/<timestamp>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Compare two saved runs and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.requests is None and args.duration is None:
+        args.requests = 200
+
+    base_url = args.url.rstrip('/')
+    if not wait_until_ready(base_url):
+        raise SystemExit(f"{base_url} did not report ready")
+    key, sheets = load_images(args)
+    session_ids = create_sessions(base_url, key, args.sessions)
+    report = run_load(base_url, session_ids, sheets, parse_mix(args.mix), args.requests, args.duration,
+                      args.concurrency, args.rate)
+    print_report(report)
+    print(f"Saved to {save_report(report, args, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
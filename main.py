@@ -1,3 +1,9 @@
+"""
+WSGI entry point
+Production: gunicorn --config gunicorn.conf.py main:app
+Development: python main.py
+"""
+
 from app import app
 
 if __name__ == "__main__":
@@ -1,44 +1,133 @@
-import cv2
 import numpy as np
 import logging
 import os
-from sklearn.cluster import KMeans
-from ml_model import BubbleDetectorModel
+import threading
+import time
 
-# Initialize the ML model
-bubble_detector = BubbleDetectorModel()
+from pipeline import DEFAULT_PARAMS, as_sheet, bubble_region, load_sheet
+
+# OpenCV, scikit-learn and the bubble detector are loaded on first use (or by
+# warm_up()) rather than at import time, so the web app can start serving
+# health checks before the grading engine is ready.
 
 logger = logging.getLogger(__name__)
 
-def preprocess_image(image_path):
+_bubble_detector = None
+_bubble_detector_lock = threading.Lock()
+# Retraining rewrites the shared model; request threads and the background
+# grading threads must not train it concurrently
+_training_lock = threading.Lock()
+_warm_up_thread = None
+_engine_status = {
+    'state': 'cold',  # 'cold', 'warming', 'ready' or 'failed'
+    'warm_up_seconds': None,
+    'error': None
+}
+
+
+def get_bubble_detector():
+    """
+    Return the shared bubble detector, loading it on first use
+    
+    Returns:
+        BubbleDetectorModel: The process-wide model instance
+    """
+    global _bubble_detector
+    if _bubble_detector is None:
+        with _bubble_detector_lock:
+            if _bubble_detector is None:
+                from ml_model import BubbleDetectorModel
+                _bubble_detector = BubbleDetectorModel()
+    return _bubble_detector
+
+
+def warm_up():
+    """
+    Import the heavy dependencies and load the bubble detector
+    
+    Returns:
+        float: Time spent warming up, in seconds
+    """
+    _engine_status['state'] = 'warming'
+    start = time.perf_counter()
+    try:
+        import cv2  # noqa: F401
+        from sklearn.cluster import KMeans  # noqa: F401
+        get_bubble_detector()
+    except Exception as e:
+        _engine_status.update(state='failed', error=str(e))
+        logger.error(f"Error warming up grading engine: {str(e)}")
+        raise
+    
+    elapsed = time.perf_counter() - start
+    _engine_status.update(state='ready', warm_up_seconds=elapsed, error=None)
+    logger.info(f"Grading engine warmed up in {elapsed:.3f}s")
+    return elapsed
+
+
+def start_warm_up_thread():
+    """
+    Warm up the grading engine in a background daemon thread
+    
+    Returns:
+        threading.Thread: The warm-up thread (already started)
+    """
+    global _warm_up_thread
+    if _warm_up_thread is None:
+        def _run():
+            try:
+                warm_up()
+            except Exception:
+                pass  # Already logged; requests fall back to lazy loading
+        
+        _warm_up_thread = threading.Thread(target=_run, name='grading-warm-up', daemon=True)
+        _warm_up_thread.start()
+    return _warm_up_thread
+
+
+def engine_status():
+    """
+    Report whether the grading engine is warm
+    
+    Returns:
+        dict: State, warm-up duration and last error
+    """
+    status = dict(_engine_status)
+    if status['state'] != 'ready' and _bubble_detector is not None:
+        # Loaded lazily by a request before (or without) the warm-up thread
+        status['state'] = 'ready'
+    return status
+
+
+def binarize(gray, params=None):
+    """
+    Blur and threshold a grayscale image (ink becomes white)
+    
+    Args:
+        gray (numpy.ndarray): Grayscale image
+        params (PreprocessParams): Settings, or None for the defaults
+        
+    Returns:
+        numpy.ndarray: Binary image
+    """
+    return (params or DEFAULT_PARAMS).binarize(gray)
+
+def preprocess_image(image_path, reduction=1, params=None):
     """
     Preprocess the image for better feature extraction
     
     Args:
         image_path (str): Path to the image file
+        reduction (int): Decode at 1/2, 1/4 or 1/8 resolution (2, 4 or 8);
+            JPEGs are then downscaled by the decoder itself, which is much
+            cheaper than decoding at full size
+        params (PreprocessParams): Settings, or None for the defaults
         
     Returns:
         numpy.ndarray: Preprocessed image
     """
     try:
-        # Read the image
-        img = cv2.imread(image_path)
-        if img is None:
-            raise ValueError(f"Could not read image at {image_path}")
-        
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # Apply Gaussian blur to reduce noise
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        
-        # Apply adaptive thresholding to get binary image
-        thresh = cv2.adaptiveThreshold(
-            blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY_INV, 11, 2
-        )
-        
-        return thresh
+        return load_sheet(image_path, reduction, params).thresh
     
     except Exception as e:
         logger.error(f"Error preprocessing image: {str(e)}")
@@ -49,12 +138,16 @@ def detect_grid(img):
     Detect the grid structure in the MCQ sheet
     
     Args:
-        img (numpy.ndarray): Preprocessed image
+        img (numpy.ndarray or SheetPipeline): Preprocessed image
         
     Returns:
         tuple: Coordinates of the grid (x, y, width, height)
     """
     try:
+        import cv2
+        
+        img = as_sheet(img).thresh
+        
         # Find contours
         contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
@@ -91,102 +184,64 @@ def detect_grid(img):
         logger.error(f"Error detecting grid: {str(e)}")
         raise
 
-def extract_answers(img, grid_coords):
+def extract_answers(img, grid_coords, method='ml', return_confidence=False, bubble_log=None):
     """
     Extract the marked answers from the MCQ sheet
     
     Args:
-        img (numpy.ndarray): Preprocessed image
+        img (numpy.ndarray or SheetPipeline): Preprocessed image; a
+            SheetPipeline keeps the bubbles found for later consumers
         grid_coords (tuple): Coordinates of the grid (x, y, width, height)
+        method (str): 'ml' to classify bubbles with the bubble detector, or
+            'fill_ratio' to pick the bubble with the most marked pixels
+        return_confidence (bool): Also return a confidence per answer
+        bubble_log (list): If given, one (question_idx, choice_idx, center_x,
+            center_y, width, height, selected) tuple per bubble is appended,
+            in grid-region coordinates
         
     Returns:
-        list: List of marked answers
+        list: List of marked answers, or (answers, confidences) if
+            return_confidence is set
     """
     try:
-        x, y, w, h = grid_coords
+        # Bubbles grouped into rows (top to bottom), each sorted by x-coordinate
+        grid_region, sorted_rows = as_sheet(img).rows(grid_coords)
         
-        # Extract the grid region
-        grid_region = img[y:y+h, x:x+w]
-        
-        # Find contours in the grid region
-        contours, _ = cv2.findContours(grid_region, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
-        
-        if not contours:
-            logger.warning("No contours found in the grid region")
-            return []
-        
-        # Filter contours to find circles (bubbles)
-        bubbles = []
-        for contour in contours:
-            # Approximate the contour
-            peri = cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
-            
-            # Get bounding rectangle
-            rect_x, rect_y, rect_w, rect_h = cv2.boundingRect(contour)
-            
-            # Check if it's reasonably circular and not too small or too large
-            aspect_ratio = float(rect_w) / rect_h if rect_h != 0 else 0
-            area = cv2.contourArea(contour)
-            
-            # Criteria for potential bubbles
-            if 0.8 <= aspect_ratio <= 1.2 and grid_region.size / 1000 > area > 30:
-                # Add the center point and area of the bubble
-                center_x = rect_x + rect_w // 2
-                center_y = rect_y + rect_h // 2
-                bubbles.append((center_x, center_y, area, rect_w, rect_h))
-        
-        if not bubbles:
-            logger.warning("No suitable bubbles found")
-            return []
-        
-        # Use K-means to cluster bubbles into rows
-        if len(bubbles) > 1:
-            # Extract y-coordinates for clustering
-            bubble_centers_y = np.array([b[1] for b in bubbles]).reshape(-1, 1)
-            
-            # Estimate number of rows
-            estimated_rows = min(len(bubbles) // 2, 20)  # Assume at least 2 bubbles per row, max 20 rows
-            kmeans = KMeans(n_clusters=estimated_rows, random_state=0).fit(bubble_centers_y)
-            
-            # Group bubbles by row
-            rows = {}
-            for i, (bubble, row_label) in enumerate(zip(bubbles, kmeans.labels_)):
-                if row_label not in rows:
-                    rows[row_label] = []
-                rows[row_label].append(bubble)
-            
-            # Sort rows by y-coordinate
-            sorted_rows = sorted(rows.items(), key=lambda x: np.mean([b[1] for b in x[1]]))
-            
+        if sorted_rows:
             # For each row, find the marked bubble (if any)
             answers = []
-            for row_label, row_bubbles in sorted_rows:
-                # Sort bubbles in this row by x-coordinate
-                sorted_row_bubbles = sorted(row_bubbles, key=lambda b: b[0])
-                
+            confidences = []
+            for sorted_row_bubbles in sorted_rows:
                 # Use ML model to detect filled bubbles
                 best_bubble_idx = None
                 highest_confidence = 0
                 
-                # Check each bubble with ML model
+                # Extract the bubble regions for classification
+                regions = []
                 for i, bubble in enumerate(sorted_row_bubbles):
-                    center_x, center_y, area, width, height = bubble
-                    
-                    # Extract the bubble region for ML classification
-                    bubble_region = grid_region[center_y-height//2:center_y+height//2, 
-                                                center_x-width//2:center_x+width//2]
-                    
-                    if bubble_region.size == 0:
+                    region = bubble_region(grid_region, bubble)
+                    if region.size == 0:
                         continue
-                    
-                    # Use ML model to predict if bubble is filled
-                    prediction, confidence = bubble_detector.predict(bubble_region)
-                    
-                    # If the bubble is predicted as filled and has higher confidence
-                    if prediction == 1 and confidence > highest_confidence:
-                        highest_confidence = confidence
-                        best_bubble_idx = i
+                    regions.append((i, region))
+                
+                if method == 'fill_ratio':
+                    # Fast path: the bubble with the largest share of marked
+                    # pixels wins; confidence is its margin over the runner-up
+                    if regions:
+                        ratios = [np.count_nonzero(r) / r.size for _, r in regions]
+                        order = np.argsort(ratios)[::-1]
+                        best_bubble_idx = regions[order[0]][0]
+                        best = ratios[order[0]]
+                        second = ratios[order[1]] if len(order) > 1 else 0
+                        highest_confidence = (best - second) / best if best > 0 else 0
+                else:
+                    # Classify the whole row in one batch
+                    predictions = get_bubble_detector().predict_batch([r for _, r in regions])
+                    for (i, _), (prediction, confidence) in zip(regions, predictions):
+                        # If the bubble is predicted as filled and has higher confidence
+                        if prediction == 1 and confidence > highest_confidence:
+                            highest_confidence = confidence
+                            best_bubble_idx = i
                         
                 # Fallback to traditional detection if ML doesn't find a filled bubble
                 if best_bubble_idx is None:
@@ -199,15 +254,21 @@ def extract_answers(img, grid_coords):
                 
                 # If a bubble seems to be filled, record its position
                 if best_bubble_idx is not None:
+                    if bubble_log is not None:
+                        for i, (center_x, center_y, area, width, height) in enumerate(sorted_row_bubbles):
+                            bubble_log.append((len(answers), i, center_x, center_y, width, height,
+                                               i == best_bubble_idx))
+                    
                     # Convert to answer choice ('A', 'B', 'C', 'D', 'E')
                     choice_idx = best_bubble_idx
                     choice = chr(65 + choice_idx) if choice_idx < 26 else f"Choice {choice_idx+1}"
                     answers.append(choice)
+                    # Rows decided by the area fallback carry no confidence
+                    confidences.append(float(highest_confidence))
             
-            return answers
+            return (answers, confidences) if return_confidence else answers
         else:
-            logger.warning("Not enough bubbles found for clustering")
-            return []
+            return ([], []) if return_confidence else []
     
     except Exception as e:
         logger.error(f"Error extracting answers: {str(e)}")
@@ -218,7 +279,8 @@ def collect_training_data(img, grid_coords, answers):
     Collect training data from a processed sheet
     
     Args:
-        img (numpy.ndarray): Preprocessed image
+        img (numpy.ndarray or SheetPipeline): Preprocessed image; pass the
+            SheetPipeline answers were extracted from to reuse its bubbles
         grid_coords (tuple): Coordinates of the grid (x, y, width, height)
         answers (list): List of marked answers
         
@@ -228,77 +290,16 @@ def collect_training_data(img, grid_coords, answers):
     try:
         if not os.path.exists('static/models'):
             os.makedirs('static/models')
-            
-        x, y, w, h = grid_coords
-        
-        # Extract the grid region
-        grid_region = img[y:y+h, x:x+w]
         
-        # Find contours in the grid region
-        contours, _ = cv2.findContours(grid_region, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+        # Bubbles grouped into rows (top to bottom), each sorted by x-coordinate
+        grid_region, sorted_rows = as_sheet(img).rows(grid_coords)
         
-        if not contours:
-            logger.warning("No contours found in the grid region for training")
-            return
-        
-        # Find all bubbles
-        bubbles = []
-        for contour in contours:
-            # Get bounding rectangle
-            rect_x, rect_y, rect_w, rect_h = cv2.boundingRect(contour)
-            
-            # Check if it's reasonably circular and not too small or too large
-            aspect_ratio = float(rect_w) / rect_h if rect_h != 0 else 0
-            area = cv2.contourArea(contour)
-            
-            # Criteria for potential bubbles
-            if 0.8 <= aspect_ratio <= 1.2 and grid_region.size / 1000 > area > 30:
-                # Add bubble info
-                center_x = rect_x + rect_w // 2
-                center_y = rect_y + rect_h // 2
-                bubble_region = grid_region[
-                    max(0, center_y-rect_h//2):min(grid_region.shape[0], center_y+rect_h//2), 
-                    max(0, center_x-rect_w//2):min(grid_region.shape[1], center_x+rect_w//2)
-                ]
-                
-                if bubble_region.size > 0:
-                    bubbles.append({
-                        'center_x': center_x,
-                        'center_y': center_y,
-                        'region': bubble_region,
-                        'width': rect_w,
-                        'height': rect_h,
-                        'area': area
-                    })
-        
-        if not bubbles:
-            logger.warning("No suitable bubbles found for training")
-            return
-        
-        # Cluster bubbles into rows using K-means
-        if len(bubbles) > 1:
-            # Extract y-coordinates for clustering
-            bubble_centers_y = np.array([b['center_y'] for b in bubbles]).reshape(-1, 1)
-            
-            # Estimate number of rows
-            estimated_rows = min(len(bubbles) // 2, 20)
-            kmeans = KMeans(n_clusters=estimated_rows, random_state=0).fit(bubble_centers_y)
-            
-            # Group bubbles by row
-            rows = {}
-            for i, (bubble, row_label) in enumerate(zip(bubbles, kmeans.labels_)):
-                if row_label not in rows:
-                    rows[row_label] = []
-                rows[row_label].append(bubble)
-            
-            # Sort rows by y-coordinate
-            sorted_rows = sorted(rows.items(), key=lambda x: np.mean([b['center_y'] for b in x[1]]))
-            
+        if sorted_rows:
             # For known answers, build training data
             marked_bubbles = []
             empty_bubbles = []
             
-            for row_idx, (row_label, row_bubbles) in enumerate(sorted_rows):
+            for row_idx, sorted_row_bubbles in enumerate(sorted_rows):
                 if row_idx >= len(answers):
                     break
                     
@@ -306,22 +307,21 @@ def collect_training_data(img, grid_coords, answers):
                 answer = answers[row_idx]
                 choice_idx = ord(answer) - 65 if 'A' <= answer <= 'Z' else int(answer.split()[-1]) - 1
                 
-                # Sort bubbles in this row by x-coordinate
-                sorted_row_bubbles = sorted(row_bubbles, key=lambda b: b['center_x'])
-                
                 if choice_idx < len(sorted_row_bubbles):
                     # Add marked bubble to training set
-                    marked_bubbles.append(sorted_row_bubbles[choice_idx]['region'])
+                    marked_bubbles.append(bubble_region(grid_region, sorted_row_bubbles[choice_idx]))
                     
                     # Add other bubbles as empty examples
                     for i, bubble in enumerate(sorted_row_bubbles):
                         if i != choice_idx:
-                            empty_bubbles.append(bubble['region'])
+                            empty_bubbles.append(bubble_region(grid_region, bubble))
             
             # Train the model if we have enough data
             if len(marked_bubbles) >= 5 and len(empty_bubbles) >= 5:
+                bubble_detector = get_bubble_detector()
                 X, y = bubble_detector.collect_training_data(marked_bubbles, empty_bubbles)
-                bubble_detector.train(X, y)
+                with _training_lock:
+                    bubble_detector.train(X, y)
                 logger.info(f"Model trained with {len(marked_bubbles)} marked and {len(empty_bubbles)} empty bubbles")
     
     except Exception as e:
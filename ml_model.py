@@ -4,21 +4,31 @@ This module provides ML capabilities to improve the accuracy of bubble detection
 """
 
 import os
+import time
 import pickle
+import threading
 import numpy as np
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score, classification_report
+from compact_model import current_version, export_compact_model, load_current, load_if_current, replace_file
+
+# scikit-learn is imported inside the methods that need it so that importing
+# this module stays cheap; the estimators are only built on first load/train.
 
 # Path to save the trained model
 MODEL_PATH = os.path.join('static', 'models')
 MODEL_FILE = os.path.join(MODEL_PATH, 'bubble_detector.pkl')
 SCALER_FILE = os.path.join(MODEL_PATH, 'feature_scaler.pkl')
+# Array-based export of the same model, see compact_model.py
+COMPACT_MODEL_DIR = os.path.join(MODEL_PATH, 'bubble_detector_compact')
+# Seconds between checks for an export published by another process
+RELOAD_INTERVAL = 2.0
+
 
-# Ensure the model directory exists
-if not os.path.exists(MODEL_PATH):
-    os.makedirs(MODEL_PATH)
+def _new_estimators():
+    """Create an untrained classifier and feature scaler"""
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.preprocessing import StandardScaler
+
+    return RandomForestClassifier(n_estimators=100, random_state=42), StandardScaler()
 
 class BubbleDetectorModel:
     """
@@ -30,11 +40,28 @@ class BubbleDetectorModel:
         """Initialize the model"""
         self.model = None
         self.scaler = None
+        self.compact = None
         self.is_trained = False
+        self._checked_at = time.monotonic()
+        # Guards swapping model and scaler as a pair; predictions read them
+        # while another thread retrains
+        self._swap_lock = threading.Lock()
         self._load_model()
     
     def _load_model(self):
         """Load a trained model if available"""
+        try:
+            # Prefer the memory-mapped export; the forest is then only
+            # rebuilt when the model is retrained
+            self.compact = load_if_current(COMPACT_MODEL_DIR, MODEL_FILE)
+            if self.compact is not None:
+                self.is_trained = True
+                print("Compact model loaded successfully")
+                return
+        except Exception as e:
+            print(f"Error loading compact model: {e}")
+            self.compact = None
+        
         try:
             if os.path.exists(MODEL_FILE) and os.path.exists(SCALER_FILE):
                 with open(MODEL_FILE, 'rb') as model_file:
@@ -43,14 +70,13 @@ class BubbleDetectorModel:
                     self.scaler = pickle.load(scaler_file)
                 self.is_trained = True
                 print("Model loaded successfully")
+                self._export_compact()
             else:
                 print("No pre-trained model found. Creating a new model.")
-                self.model = RandomForestClassifier(n_estimators=100, random_state=42)
-                self.scaler = StandardScaler()
+                self.model, self.scaler = _new_estimators()
         except Exception as e:
             print(f"Error loading model: {e}")
-            self.model = RandomForestClassifier(n_estimators=100, random_state=42)
-            self.scaler = StandardScaler()
+            self.model, self.scaler = _new_estimators()
     
     def extract_features(self, bubble_image):
         """
@@ -99,32 +125,70 @@ class BubbleDetectorModel:
             print("Not enough samples for training. Need at least 10 samples.")
             return 0.0
         
+        from sklearn.model_selection import train_test_split
+        from sklearn.metrics import accuracy_score, classification_report
+        
+        # Fit fresh estimators and swap them in when done, so predictions
+        # running meanwhile keep using the previous, complete model
+        model, scaler = _new_estimators()
+        
         # Split data into training and validation sets
         X_train, X_val, y_train, y_val = train_test_split(
             X, y, test_size=0.2, random_state=42)
         
         # Scale features
-        X_train_scaled = self.scaler.fit_transform(X_train)
-        X_val_scaled = self.scaler.transform(X_val)
+        X_train_scaled = scaler.fit_transform(X_train)
+        X_val_scaled = scaler.transform(X_val)
         
         # Train the model
-        self.model.fit(X_train_scaled, y_train)
+        model.fit(X_train_scaled, y_train)
         
         # Evaluate
-        y_pred = self.model.predict(X_val_scaled)
+        y_pred = model.predict(X_val_scaled)
         accuracy = accuracy_score(y_val, y_pred)
         print(f"Model trained with accuracy: {accuracy:.4f}")
         print(classification_report(y_val, y_pred))
         
-        # Save the model
-        with open(MODEL_FILE, 'wb') as model_file:
-            pickle.dump(self.model, model_file)
-        with open(SCALER_FILE, 'wb') as scaler_file:
-            pickle.dump(self.scaler, scaler_file)
+        # Save the model; other workers may be reading the files, so they
+        # are replaced rather than rewritten
+        if not os.path.exists(MODEL_PATH):
+            os.makedirs(MODEL_PATH)
+        replace_file(MODEL_FILE, pickle.dumps(model))
+        replace_file(SCALER_FILE, pickle.dumps(scaler))
+        with self._swap_lock:
+            self.model, self.scaler = model, scaler
+        self._export_compact()
         
         self.is_trained = True
         return accuracy
     
+    def _export_compact(self):
+        """Refresh the compact export from the current forest"""
+        try:
+            self.compact = export_compact_model(
+                self.model, self.scaler, COMPACT_MODEL_DIR, source_file=MODEL_FILE)
+        except Exception as e:
+            print(f"Error exporting compact model: {e}")
+            self.compact = None
+    
+    def _reload_if_changed(self):
+        """Switch to a newer compact export, e.g. one published by another worker"""
+        now = time.monotonic()
+        if now - self._checked_at < RELOAD_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            version = current_version(COMPACT_MODEL_DIR)
+            if version is None or (self.compact is not None and self.compact.version == version):
+                return
+            compact = load_current(COMPACT_MODEL_DIR)
+        except Exception as e:
+            print(f"Error reloading compact model: {e}")
+            return
+        if compact is not None:
+            self.compact = compact
+            self.is_trained = True
+    
     def predict(self, bubble_image):
         """
         Predict if a bubble is filled
@@ -135,6 +199,7 @@ class BubbleDetectorModel:
         Returns:
             tuple: (prediction (1=filled, 0=empty), confidence)
         """
+        self._reload_if_changed()
         if not self.is_trained:
             # Fallback to traditional threshold-based detection
             mean_intensity = np.mean(bubble_image)
@@ -145,15 +210,44 @@ class BubbleDetectorModel:
         # Extract features
         features = self.extract_features(bubble_image)
         
+        compact = self.compact
+        if compact is not None:
+            labels, confidences = compact.predict(features)
+            return int(labels[0]), float(confidences[0])
+        
+        with self._swap_lock:
+            model, scaler = self.model, self.scaler
+        
         # Scale features
-        features_scaled = self.scaler.transform(features)
+        features_scaled = scaler.transform(features)
         
         # Predict
-        prediction = self.model.predict(features_scaled)[0]
-        confidence = np.max(self.model.predict_proba(features_scaled)[0])
+        prediction = model.predict(features_scaled)[0]
+        confidence = np.max(model.predict_proba(features_scaled)[0])
         
         return prediction, confidence
     
+    def predict_batch(self, bubble_images):
+        """
+        Predict several bubbles at once
+        
+        Args:
+            bubble_images (list): Grayscale images of potential bubbles
+            
+        Returns:
+            list: (prediction, confidence) tuples, one per image
+        """
+        if not bubble_images:
+            return []
+        self._reload_if_changed()
+        compact = self.compact
+        if not self.is_trained or compact is None:
+            return [self.predict(bubble_image) for bubble_image in bubble_images]
+        
+        features = np.vstack([self.extract_features(b) for b in bubble_images])
+        labels, confidences = compact.predict(features)
+        return [(int(label), float(confidence)) for label, confidence in zip(labels, confidences)]
+    
     def collect_training_data(self, marked_bubbles, empty_bubbles):
         """
         Collect training data from a set of manually classified bubbles
@@ -0,0 +1,143 @@
+"""
+Annotated sheet overlays and thumbnails
+When a sheet is graded, the detected bubble positions and decisions are
+saved next to it in the session's 'derived' directory. The overlay (each
+bubble outlined by outcome) and its thumbnail are only rendered the first
+time they are requested, then served from disk.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+DERIVED_DIR = 'derived'
+THUMBNAIL_WIDTH = 320
+
+# BGR outline colours
+SELECTED_CORRECT = (0, 170, 0)
+SELECTED_WRONG = (0, 0, 220)
+MISSED_CORRECT = (220, 120, 0)
+UNSELECTED = (160, 160, 160)
+
+
+def derived_path(sheet_path, suffix):
+    """
+    Path of a file derived from a graded sheet
+
+    Args:
+        sheet_path (str): Path the sheet was saved at
+        suffix (str): e.g. '.bubbles.npz', '.overlay.jpg'
+
+    Returns:
+        str: Path inside the sheet directory's 'derived' folder
+    """
+    directory = os.path.join(os.path.dirname(sheet_path), DERIVED_DIR)
+    return os.path.join(directory, os.path.basename(sheet_path) + suffix)
+
+
+def save_bubble_layout(sheet_path, bubbles, image_size):
+    """
+    Store the bubbles detected on a sheet for later rendering
+
+    Args:
+        sheet_path (str): Path the sheet was saved at
+        bubbles (numpy.ndarray): (question, choice, x, y, w, h, selected) rows
+            in full-resolution page coordinates
+        image_size (tuple): Full-resolution (height, width) of the sheet
+    """
+    path = derived_path(sheet_path, '.bubbles.npz')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, bubbles=bubbles, image_size=np.array(image_size))
+
+
+def _write_jpeg(path, img, quality=85):
+    import cv2
+
+    # Write under a temporary name so concurrent requests never read a partial
+    # file; the name is unique per call, as several threads may render the
+    # same sheet at once
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp.jpg')
+    os.close(fd)
+    try:
+        if not cv2.imwrite(tmp_path, img, [cv2.IMWRITE_JPEG_QUALITY, quality]):
+            raise ValueError(f"Could not write {path}")
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def render_overlay(sheet_path, image_path, key_codes, answer_codes):
+    """
+    Draw each detected bubble on the sheet, coloured by outcome
+
+    Args:
+        sheet_path (str): Path the sheet was saved at (locates the layout)
+        image_path (str): Image to draw on (the original or its archival copy)
+        key_codes (bytes): Encoded answer key
+        answer_codes (bytes): Encoded student answers
+
+    Returns:
+        str: Path of the cached overlay JPEG, or None if the sheet or its
+            bubble layout has been removed by the storage sweep
+    """
+    import cv2
+
+    overlay_path = derived_path(sheet_path, '.overlay.jpg')
+    if os.path.exists(overlay_path):
+        return overlay_path
+
+    try:
+        layout = np.load(derived_path(sheet_path, '.bubbles.npz'))
+    except FileNotFoundError:
+        return None
+    img = cv2.imread(image_path)
+    if img is None:
+        return None
+    # The archival copy may be smaller than the image the bubbles were found on
+    scale = img.shape[1] / layout['image_size'][1]
+
+    for question, choice, x, y, w, h, selected in layout['bubbles']:
+        if question >= len(key_codes):
+            continue
+        is_key = key_codes[question] == choice + 1
+        if selected:
+            colour = SELECTED_CORRECT if answer_codes[question] == key_codes[question] else SELECTED_WRONG
+            thickness = 3
+        elif is_key:
+            colour, thickness = MISSED_CORRECT, 2
+        else:
+            colour, thickness = UNSELECTED, 1
+        center = (int(x * scale), int(y * scale))
+        radius = max(int(max(w, h) * scale / 2) + 2, 3)
+        cv2.circle(img, center, radius, colour, thickness)
+
+    _write_jpeg(overlay_path, img)
+    return overlay_path
+
+
+def render_thumbnail(overlay_path, width=THUMBNAIL_WIDTH):
+    """
+    Downscaled copy of an overlay
+
+    Args:
+        overlay_path (str): Overlay produced by render_overlay
+        width (int): Thumbnail width in pixels
+
+    Returns:
+        str: Path of the cached thumbnail JPEG, or None if the overlay is gone
+    """
+    import cv2
+
+    thumbnail_path = overlay_path.replace('.overlay.jpg', '.thumb.jpg')
+    if os.path.exists(thumbnail_path):
+        return thumbnail_path
+
+    img = cv2.imread(overlay_path)
+    if img is None:
+        return None
+    height = int(img.shape[0] * width / img.shape[1])
+    _write_jpeg(thumbnail_path, cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA), quality=80)
+    return thumbnail_path
@@ -0,0 +1,339 @@
+"""
+Per-sheet preprocessing pipeline
+A SheetPipeline holds one decoded sheet and computes its intermediates
+(binary image, grid contours, bubble list, bubbles grouped into rows) on
+first use, so that answer extraction and training data collection share
+them instead of each running findContours and the row clustering again.
+
+How a sheet is binarised is set by PreprocessParams, which can differ per
+answer key layout. Besides the default (Gaussian blur, adaptive Gaussian
+threshold), cheaper variants are available: box blur, no blur, adaptive
+mean threshold (box-filter based) and global Otsu. Run this module to
+benchmark them on sample sheets.
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class PreprocessParams:
+    """
+    Binarisation and bubble filtering settings for one sheet layout.
+    The defaults reproduce the original preprocessing.
+    """
+
+    BLURS = ('gaussian', 'box', 'none')
+    THRESHOLDS = ('adaptive', 'adaptive_mean', 'otsu')
+
+    def __init__(self, blur='gaussian', blur_size=5, threshold='adaptive', block_size=11, offset=2,
+                 min_bubble_area=30, max_bubble_fraction=0.001, aspect_tolerance=0.2):
+        """
+        Args:
+            blur (str): 'gaussian', 'box' or 'none'
+            blur_size (int): Blur kernel size (odd for 'gaussian')
+            threshold (str): 'adaptive' (Gaussian-weighted), 'adaptive_mean'
+                or 'otsu' (one global threshold)
+            block_size (int): Neighbourhood size of the adaptive thresholds (odd)
+            offset (int): Constant subtracted from the adaptive threshold
+            min_bubble_area (float): Smallest contour area taken as a bubble
+            max_bubble_fraction (float): Largest bubble area, as a fraction of the grid area
+            aspect_tolerance (float): Allowed deviation of width / height from 1
+        """
+        if blur not in self.BLURS:
+            raise ValueError(f"Unknown blur {blur!r}, expected one of {self.BLURS}")
+        if threshold not in self.THRESHOLDS:
+            raise ValueError(f"Unknown threshold {threshold!r}, expected one of {self.THRESHOLDS}")
+        if block_size < 3 or block_size % 2 == 0:
+            raise ValueError(f"block_size must be odd and at least 3, got {block_size}")
+        if blur == 'gaussian' and (blur_size < 1 or blur_size % 2 == 0):
+            raise ValueError(f"blur_size must be odd and positive for a gaussian blur, got {blur_size}")
+        if blur == 'box' and blur_size < 1:
+            raise ValueError(f"blur_size must be positive, got {blur_size}")
+        self.blur = blur
+        self.blur_size = blur_size
+        self.threshold = threshold
+        self.block_size = block_size
+        self.offset = offset
+        self.min_bubble_area = min_bubble_area
+        self.max_bubble_fraction = max_bubble_fraction
+        self.aspect_tolerance = aspect_tolerance
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Parse settings given as 'name=value,...', e.g. 'blur=box,threshold=otsu'
+
+        Args:
+            value (str): Settings; empty for the defaults
+
+        Returns:
+            PreprocessParams: Parsed settings
+        """
+        defaults = cls().to_dict()
+        kwargs = {}
+        for item in filter(None, (part.strip() for part in (value or '').split(','))):
+            name, _, raw = item.partition('=')
+            name = name.strip()
+            if name not in defaults:
+                raise ValueError(f"Unknown preprocessing setting {name!r}")
+            kwargs[name] = type(defaults[name])(raw.strip())
+        return cls(**kwargs)
+
+    def scaled(self, reduction):
+        """
+        Settings for a sheet decoded at 1/reduction resolution: kernel sizes
+        shrink with the image and the bubble area with its square, so the
+        same bubbles are found as at full resolution
+
+        Args:
+            reduction (int): Decode reduction factor (1, 2, 4 or 8)
+
+        Returns:
+            PreprocessParams: Scaled settings (self for reduction 1)
+        """
+        if reduction == 1:
+            return self
+
+        def odd(size, minimum):
+            size = max(int(round(size / reduction)), minimum)
+            return size if size % 2 else size + 1
+
+        return PreprocessParams(
+            blur=self.blur,
+            blur_size=odd(self.blur_size, 1),
+            threshold=self.threshold,
+            block_size=odd(self.block_size, 3),
+            offset=self.offset,
+            min_bubble_area=self.min_bubble_area / reduction ** 2,
+            max_bubble_fraction=self.max_bubble_fraction,
+            aspect_tolerance=self.aspect_tolerance
+        )
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def __eq__(self, other):
+        return isinstance(other, PreprocessParams) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return f"PreprocessParams({', '.join(f'{k}={v!r}' for k, v in vars(self).items())})"
+
+    def binarize(self, gray):
+        """
+        Blur and threshold a grayscale image (ink becomes white)
+
+        Args:
+            gray (numpy.ndarray): Grayscale image
+
+        Returns:
+            numpy.ndarray: Binary image
+        """
+        import cv2
+
+        if self.blur == 'gaussian':
+            blurred = cv2.GaussianBlur(gray, (self.blur_size, self.blur_size), 0)
+        elif self.blur == 'box':
+            blurred = cv2.blur(gray, (self.blur_size, self.blur_size))
+        else:
+            blurred = gray
+
+        if self.threshold == 'otsu':
+            _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+            return thresh
+        method = cv2.ADAPTIVE_THRESH_GAUSSIAN_C if self.threshold == 'adaptive' else cv2.ADAPTIVE_THRESH_MEAN_C
+        return cv2.adaptiveThreshold(blurred, 255, method, cv2.THRESH_BINARY_INV, self.block_size, self.offset)
+
+
+DEFAULT_PARAMS = PreprocessParams()
+
+
+def bubble_region(grid_region, bubble):
+    """Pixels of one bubble (center_x, center_y, area, width, height) within the grid region"""
+    center_x, center_y, _, width, height = bubble
+    return grid_region[center_y - height // 2:center_y + height // 2,
+                       center_x - width // 2:center_x + width // 2]
+
+
+class SheetPipeline:
+    """
+    One sheet and its memoised preprocessing intermediates.
+    Results for a grid are cached per grid coordinates, so a sheet can be
+    processed against several grids (e.g. exam versions) without clashes.
+    """
+
+    def __init__(self, gray=None, params=None, thresh=None):
+        """
+        Args:
+            gray (numpy.ndarray): Grayscale sheet
+            params (PreprocessParams): Settings, or None for the defaults
+            thresh (numpy.ndarray): Already binarised sheet, if there is no
+                grayscale image
+        """
+        if gray is None and thresh is None:
+            raise ValueError("A grayscale or binary image is required")
+        self.gray = gray
+        self.params = params or DEFAULT_PARAMS
+        self._thresh = thresh
+        self._rows = {}
+
+    @classmethod
+    def load(cls, image_path, reduction=1, params=None):
+        """
+        Decode a sheet
+
+        Args:
+            image_path (str): Path to the image file
+            reduction (int): Decode at 1/2, 1/4 or 1/8 resolution (2, 4 or 8);
+                JPEGs are then downscaled by the decoder itself
+            params (PreprocessParams): Settings, or None for the defaults
+
+        Returns:
+            SheetPipeline: The decoded sheet
+        """
+        import cv2
+
+        if reduction == 1:
+            img = cv2.imread(image_path)
+            if img is None:
+                raise ValueError(f"Could not read image at {image_path}")
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        else:
+            flags = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                     8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+            if reduction not in flags:
+                raise ValueError(f"Unsupported reduction factor {reduction}")
+            gray = cv2.imread(image_path, flags[reduction])
+            if gray is None:
+                raise ValueError(f"Could not read image at {image_path}")
+        return cls(gray, params)
+
+    @property
+    def thresh(self):
+        """Binary image"""
+        if self._thresh is None:
+            self._thresh = self.params.binarize(self.gray)
+        return self._thresh
+
+    @property
+    def shape(self):
+        return self.thresh.shape
+
+    def rows(self, grid_coords):
+        """
+        Bubbles inside a grid, grouped into rows
+
+        Args:
+            grid_coords (tuple): Coordinates of the grid (x, y, width, height)
+
+        Returns:
+            tuple: (grid region, rows) where rows is a list, top to bottom,
+                of lists of (center_x, center_y, area, width, height) bubbles
+                sorted left to right; rows is empty if no bubbles were found
+        """
+        key = tuple(grid_coords)
+        if key not in self._rows:
+            self._rows[key] = self._find_rows(key)
+        return self._rows[key]
+
+    def _find_rows(self, grid_coords):
+        import cv2
+        from sklearn.cluster import KMeans
+
+        x, y, w, h = grid_coords
+        grid_region = self.thresh[y:y+h, x:x+w]
+
+        contours, _ = cv2.findContours(grid_region, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            logger.warning("No contours found in the grid region")
+            return grid_region, []
+
+        # Keep roughly circular contours of plausible size
+        params = self.params
+        max_area = grid_region.size * params.max_bubble_fraction
+        bubbles = []
+        for contour in contours:
+            rect_x, rect_y, rect_w, rect_h = cv2.boundingRect(contour)
+            aspect_ratio = float(rect_w) / rect_h if rect_h != 0 else 0
+            area = cv2.contourArea(contour)
+            if abs(aspect_ratio - 1) <= params.aspect_tolerance and max_area > area > params.min_bubble_area:
+                bubbles.append((rect_x + rect_w // 2, rect_y + rect_h // 2, area, rect_w, rect_h))
+
+        if len(bubbles) < 2:
+            logger.warning("Not enough bubbles found for clustering")
+            return grid_region, []
+
+        # Cluster bubbles into rows by their y-coordinate
+        # (assume at least 2 bubbles per row, max 20 rows)
+        bubble_centers_y = np.array([b[1] for b in bubbles]).reshape(-1, 1)
+        estimated_rows = min(len(bubbles) // 2, 20)
+        kmeans = KMeans(n_clusters=estimated_rows, random_state=0).fit(bubble_centers_y)
+
+        rows = {}
+        for bubble, row_label in zip(bubbles, kmeans.labels_):
+            rows.setdefault(row_label, []).append(bubble)
+
+        sorted_rows = sorted(rows.values(), key=lambda row: np.mean([b[1] for b in row]))
+        return grid_region, [sorted(row, key=lambda b: b[0]) for row in sorted_rows]
+
+
+def load_sheet(image_path, reduction=1, params=None):
+    """Decode a sheet into a SheetPipeline (see SheetPipeline.load)"""
+    return SheetPipeline.load(image_path, reduction, params)
+
+
+def as_sheet(img):
+    """Wrap an already binarised image, or pass a SheetPipeline through"""
+    return img if isinstance(img, SheetPipeline) else SheetPipeline(thresh=img)
+
+
+VARIANTS = {
+    'default': PreprocessParams(),
+    'box': PreprocessParams(blur='box'),
+    'adaptive_mean': PreprocessParams(threshold='adaptive_mean'),
+    'box_adaptive_mean': PreprocessParams(blur='box', threshold='adaptive_mean'),
+    'otsu': PreprocessParams(threshold='otsu'),
+    'box_otsu': PreprocessParams(blur='box', threshold='otsu'),
+}
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    from mcq_processor import detect_grid, extract_answers
+    # The classes as mcq_processor sees them (this file also runs as __main__)
+    from pipeline import VARIANTS, SheetPipeline, load_sheet
+
+    # Usage: python pipeline.py ANSWER_KEY [SHEET ...]
+    # Times binarisation per variant (decoding excluded) and checks that each
+    # variant, with the grid found on the key by that variant, extracts the
+    # same answers as the default settings
+    paths = sys.argv[1:]
+    if not paths:
+        sys.exit("Usage: python pipeline.py ANSWER_KEY [SHEET ...]")
+    grays = [load_sheet(path).gray for path in paths]
+
+    def answers_for(params):
+        grid_coords = detect_grid(SheetPipeline(grays[0], params))
+        if grid_coords is None:
+            return [[] for _ in grays]
+        return [extract_answers(SheetPipeline(gray, params), grid_coords, method='fill_ratio') for gray in grays]
+
+    reference = answers_for(VARIANTS['default'])
+    repeats = 10
+    for name, params in VARIANTS.items():
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for gray in grays:
+                params.binarize(gray)
+        binarize_ms = (time.perf_counter() - start) * 1000 / (repeats * len(grays))
+
+        start = time.perf_counter()
+        extracted = answers_for(params)
+        extract_ms = (time.perf_counter() - start) * 1000 / len(grays)
+        total = sum(len(expected) for expected in reference)
+        agree = sum(a == b for answers, expected in zip(extracted, reference) for a, b in zip(answers, expected))
+        print(f"{name:18s} binarize {binarize_ms:6.2f}ms  grid + extract {extract_ms:6.1f}ms  "
+              f"agreement {agree}/{total}")
@@ -0,0 +1,348 @@
+"""
+Bounded-memory session storage
+Grading results are kept as compact records (one byte per answer plus a
+packed correctness bitmap) and expanded into per-question details only when
+rendered. Sessions idle for too long are expired, and the least recently used
+sessions are spilled to disk when the in-memory estimate exceeds a cap.
+
+Requests mutate the session dict they got from the store, so a session in
+use must stay in memory: pin it (SessionStore.pinned) for as long as the
+dict is held, and it is neither spilled nor expired until released.
+"""
+
+import os
+import sys
+import time
+import pickle
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Byte used for a question the student did not answer
+NO_ANSWER = 0
+
+
+def encode_answers(answers, length=None):
+    """
+    Encode answer strings as one byte each
+
+    Args:
+        answers (list): Answers as produced by extract_answers ('A', 'B', ...
+            or 'Choice N')
+        length (int): Pad with NO_ANSWER or truncate to this many questions
+
+    Returns:
+        bytes: Choice index + 1 per question, NO_ANSWER for missing answers
+    """
+    codes = []
+    for answer in answers:
+        if len(answer) == 1 and 'A' <= answer <= 'Z':
+            codes.append(ord(answer) - 64)
+        elif answer.startswith('Choice '):
+            codes.append(min(int(answer.split()[-1]), 255))
+        else:
+            codes.append(NO_ANSWER)
+    if length is not None:
+        codes = (codes + [NO_ANSWER] * length)[:length]
+    return bytes(codes)
+
+
+def decode_answer(code):
+    """
+    Decode one answer byte back to its display string
+
+    Args:
+        code (int): Byte produced by encode_answers
+
+    Returns:
+        str: 'A'..'Z', 'Choice N' or 'No answer'
+    """
+    if code == NO_ANSWER:
+        return 'No answer'
+    choice_idx = code - 1
+    return chr(65 + choice_idx) if choice_idx < 26 else f"Choice {choice_idx+1}"
+
+
+class CompactResult:
+    """
+    A graded sheet stored as packed arrays.
+    The answer key codes are shared with the session, not copied.
+    """
+
+    __slots__ = ('student_name', 'filename', 'score', 'total', 'timestamp', 'mode',
+                 'answer_codes', 'correct_bits', 'key_codes', 'version', 'sheet_path')
+
+    def __init__(self, student_name, filename, score, total, timestamp, mode,
+                 answer_codes, correct_bits, key_codes, version=None, sheet_path=None):
+        self.student_name = student_name
+        self.filename = filename
+        self.score = score
+        self.total = total
+        self.timestamp = timestamp
+        self.mode = mode
+        self.answer_codes = answer_codes
+        self.correct_bits = correct_bits
+        self.key_codes = key_codes
+        self.version = version
+        self.sheet_path = sheet_path
+
+    @classmethod
+    def from_grading(cls, student_name, filename, key_codes, student_answers, timestamp, mode,
+                     version=None, sheet_path=None):
+        """
+        Build a record from a freshly graded sheet
+
+        Args:
+            student_name (str): Name entered for the student
+            filename (str): Stored file name of the sheet
+            key_codes (bytes): Session answer key, encoded with encode_answers
+            student_answers (list): Answers extracted from the sheet
+            timestamp (str): When the sheet was graded
+            mode (str): Detection mode ('manual', 'realtime' or 'webcam')
+            version (str): Exam version the sheet was graded against
+            sheet_path (str): Where the sheet image was saved
+
+        Returns:
+            CompactResult: The packed record
+        """
+        answer_codes = encode_answers(student_answers, length=len(key_codes))
+        key = np.frombuffer(key_codes, dtype=np.uint8)
+        given = np.frombuffer(answer_codes, dtype=np.uint8)
+        correct = (given == key) & (given != NO_ANSWER)
+        return cls(student_name, filename, int(correct.sum()), len(key_codes), timestamp, mode,
+                   answer_codes, np.packbits(correct).tobytes(), key_codes, version, sheet_path)
+
+    @property
+    def percentage(self):
+        return (self.score / self.total) * 100 if self.total > 0 else 0
+
+    @property
+    def details(self):
+        """Per-question details, in the same shape as compare_answers"""
+        correct = np.unpackbits(np.frombuffer(self.correct_bits, dtype=np.uint8), count=self.total)
+        return [
+            {
+                'question': i + 1,
+                'correct_answer': decode_answer(self.key_codes[i]),
+                'student_answer': decode_answer(self.answer_codes[i]),
+                'is_correct': bool(correct[i])
+            }
+            for i in range(self.total)
+        ]
+
+    def to_dict(self):
+        """Expand into the dict used by templates and JSON responses"""
+        return {
+            'student_name': self.student_name,
+            'filename': self.filename,
+            'score': self.score,
+            'total': self.total,
+            'percentage': self.percentage,
+            'details': self.details,
+            'timestamp': self.timestamp,
+            'mode': self.mode,
+            'version': self.version
+        }
+
+    def approx_size(self):
+        """Approximate memory held by this record, in bytes"""
+        # key_codes is shared with the session, so it is not counted here
+        return (sys.getsizeof(self) + sys.getsizeof(self.student_name) + sys.getsizeof(self.filename)
+                + sys.getsizeof(self.timestamp) + sys.getsizeof(self.answer_codes)
+                + sys.getsizeof(self.correct_bits) + sys.getsizeof(self.sheet_path))
+
+
+def approx_session_size(session):
+    """
+    Approximate memory held by one session dict
+    List entries are sized from their first item, which keeps the estimate
+    constant-time per session (records within a list are similar in size).
+
+    Args:
+        session (dict): Session data as stored by the app
+
+    Returns:
+        int: Size estimate in bytes
+    """
+    size = sys.getsizeof(session)
+    for value in session.values():
+        size += sys.getsizeof(value)
+        if isinstance(value, list) and value:
+            first = value[0]
+            item_size = first.approx_size() if isinstance(first, CompactResult) else sys.getsizeof(first)
+            size += item_size * len(value)
+    return size
+
+
+class SessionStore(MutableMapping):
+    """
+    Dict-like session storage with idle expiry and a memory cap.
+    Sessions over the cap are pickled to spill_dir (least recently used
+    first) and transparently loaded back on the next access.
+    """
+
+    def __init__(self, spill_dir, memory_cap=64 * 1024 * 1024, idle_timeout=4 * 3600, on_expire=None):
+        """
+        Args:
+            spill_dir (str): Directory for spilled sessions
+            memory_cap (int): Target upper bound for in-memory sessions, in bytes
+            idle_timeout (float): Seconds without access before a session expires
+            on_expire (callable): Called with (session_id, session) when a
+                session expires, e.g. to clean up its files
+        """
+        self.spill_dir = spill_dir
+        self.memory_cap = memory_cap
+        self.idle_timeout = idle_timeout
+        self.on_expire = on_expire
+        self._sessions = OrderedDict()  # session_id -> session, least recently used first
+        self._last_access = {}
+        self._pins = {}  # session_id -> number of holders
+        self._lock = threading.RLock()
+        self._last_sweep = 0.0
+        if not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+    def _spill_path(self, session_id):
+        return os.path.join(self.spill_dir, f"{os.path.basename(session_id)}.pkl")
+
+    def __getitem__(self, session_id):
+        with self._lock:
+            if session_id not in self._sessions:
+                path = self._spill_path(session_id)
+                if not os.path.exists(path):
+                    raise KeyError(session_id)
+                with open(path, 'rb') as f:
+                    self._sessions[session_id] = pickle.load(f)
+                os.remove(path)
+                logger.info(f"Loaded spilled session {session_id}")
+            self._sessions.move_to_end(session_id)
+            self._last_access[session_id] = time.time()
+            session = self._sessions[session_id]
+        self.enforce_limits()
+        return session
+
+    def __setitem__(self, session_id, session):
+        with self._lock:
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            self._last_access[session_id] = time.time()
+        self.enforce_limits()
+
+    def __delitem__(self, session_id):
+        with self._lock:
+            found = self._sessions.pop(session_id, None) is not None
+            self._last_access.pop(session_id, None)
+            path = self._spill_path(session_id)
+            if os.path.exists(path):
+                os.remove(path)
+                found = True
+        if not found:
+            raise KeyError(session_id)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions or os.path.exists(self._spill_path(session_id))
+
+    def __iter__(self):
+        spilled = [name[:-4] for name in os.listdir(self.spill_dir) if name.endswith('.pkl')]
+        return iter(list(self._sessions) + spilled)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def pin(self, session_id):
+        """Keep a session in memory until unpin() (calls nest)"""
+        with self._lock:
+            self._pins[session_id] = self._pins.get(session_id, 0) + 1
+
+    def unpin(self, session_id):
+        """Release a pin taken with pin()"""
+        with self._lock:
+            count = self._pins.get(session_id, 0) - 1
+            if count > 0:
+                self._pins[session_id] = count
+            else:
+                self._pins.pop(session_id, None)
+
+    @contextmanager
+    def pinned(self, session_id):
+        """
+        Hold a session for the duration of a with block
+
+        Yields:
+            dict: The session, which is not spilled or expired meanwhile
+
+        Raises:
+            KeyError: The session does not exist
+        """
+        self.pin(session_id)
+        try:
+            yield self[session_id]
+        finally:
+            self.unpin(session_id)
+
+    def memory_usage(self):
+        """Approximate bytes held by in-memory sessions"""
+        with self._lock:
+            return sum(approx_session_size(s) for s in self._sessions.values())
+
+    def stats(self):
+        """Counts and memory estimate for monitoring"""
+        with self._lock:
+            in_memory = len(self._sessions)
+        return {
+            'in_memory': in_memory,
+            'spilled': len(self) - in_memory,
+            'memory_bytes': self.memory_usage(),
+            'memory_cap': self.memory_cap
+        }
+
+    def enforce_limits(self):
+        """Expire idle sessions and spill the oldest ones while over the memory cap"""
+        now = time.time()
+        with self._lock:
+            # Expire idle sessions (at most once a minute; the scan touches disk)
+            if now - self._last_sweep >= 60:
+                self._last_sweep = now
+                for session_id in list(self._sessions):
+                    if session_id in self._pins:
+                        continue
+                    if now - self._last_access[session_id] > self.idle_timeout:
+                        self._expire(session_id, self._sessions.pop(session_id))
+                for name in os.listdir(self.spill_dir):
+                    path = os.path.join(self.spill_dir, name)
+                    if name.endswith('.pkl') and now - os.path.getmtime(path) > self.idle_timeout:
+                        with open(path, 'rb') as f:
+                            session = pickle.load(f)
+                        os.remove(path)
+                        self._expire(name[:-4], session)
+
+            # Spill least recently used sessions, always keeping the current
+            # one and those held by requests (their holders would otherwise
+            # mutate a dict that is no longer the stored session)
+            usage = self.memory_usage()
+            candidates = [session_id for session_id in list(self._sessions)[:-1]
+                          if session_id not in self._pins]
+            for session_id in candidates:
+                if usage <= self.memory_cap:
+                    break
+                session = self._sessions.pop(session_id)
+                usage -= approx_session_size(session)
+                self._last_access.pop(session_id, None)
+                with open(self._spill_path(session_id), 'wb') as f:
+                    pickle.dump(session, f, protocol=pickle.HIGHEST_PROTOCOL)
+                logger.info(f"Spilled session {session_id} to disk")
+
+    def _expire(self, session_id, session):
+        self._last_access.pop(session_id, None)
+        logger.info(f"Expired idle session {session_id}")
+        if self.on_expire is not None:
+            try:
+                self.on_expire(session_id, session)
+            except Exception as e:
+                logger.error(f"Error cleaning up expired session {session_id}: {str(e)}")
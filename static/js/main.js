@@ -184,6 +184,13 @@ document.addEventListener('DOMContentLoaded', function() {
             .then(data => {
                 // Display results
                 displayResult(data);
+                if (data.duplicate_of !== undefined) {
+                    showAlert(`This sheet was already graded (result #${data.duplicate_of + 1}); it was not added again.`, 'warning');
+                } else if (data.possible_duplicate_of !== undefined) {
+                    showAlert(`Saved, but this sheet looks like result #${data.possible_duplicate_of + 1}. Check the results page in case the same sheet was submitted twice.`, 'warning');
+                } else if (data.degraded) {
+                    showAlert(`Saved, but this sheet was graded with the faster '${data.tier}' method to stay within the time limit. Check its answers on the results page.`, 'warning');
+                }
                 
                 // Update steps
                 updateSteps(2);
@@ -182,8 +182,16 @@ document.addEventListener('DOMContentLoaded', function() {
                     updateSteps(2);
                 }
                 
-                // Show success message
-                showAlert('Image processed successfully!', 'success');
+                // Show success message (or that the sheet was already graded)
+                if (data.duplicate_of !== undefined) {
+                    showAlert(`This sheet was already graded (result #${data.duplicate_of + 1}); it was not added again.`, 'warning');
+                } else if (data.possible_duplicate_of !== undefined) {
+                    showAlert(`Saved, but this capture looks like result #${data.possible_duplicate_of + 1}. Check the results page in case the same sheet was captured twice.`, 'warning');
+                } else if (data.degraded) {
+                    showAlert(`Saved, but this capture was graded with the faster '${data.tier}' method to stay within the time limit. Check its answers on the results page.`, 'warning');
+                } else {
+                    showAlert('Image processed successfully!', 'success');
+                }
                 
                 // Enable view all results button
                 const viewResultsBtn = document.getElementById('viewResultsBtn');
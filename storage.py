@@ -0,0 +1,257 @@
+"""
+Upload storage lifecycle
+Every session gets its own directory under the upload folder so all of its
+files (answer key, student sheets, webcam captures, auto-saved CSVs) can be
+removed together. A background sweeper archives old images as downscaled,
+recompressed JPEGs, deletes files past the retention age and enforces a total
+size quota by removing the oldest files first. Files of sessions that are
+still live are exempt from the quota pass, since their answer keys and
+derived bubble layouts are needed for grading and overlays.
+"""
+
+import os
+import time
+import shutil
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+# Suffix added to an image's name when it is replaced by its archival copy
+ARCHIVE_SUFFIX = '.archive.jpg'
+# Subdirectories holding generated files, which are never archived
+NO_ARCHIVE_DIRS = {'derived', 'chunked'}
+
+
+class StorageManager:
+    """
+    Per-session upload directories with tiered retention.
+    Files start as the original upload, are replaced by an archival copy
+    after archive_after seconds and are deleted after retention seconds.
+    """
+
+    def __init__(self, root, retention=72 * 3600, archive_after=6 * 3600, quota_bytes=1024 * 1024 * 1024,
+                 archive=True, archive_max_dim=1600, archive_quality=80, sweep_interval=300, is_live=None):
+        """
+        Args:
+            root (str): Upload folder
+            retention (float): Seconds after which files are deleted
+            archive_after (float): Seconds after which images are archived
+            quota_bytes (int): Maximum total size of session directories
+            archive (bool): Replace old images with archival copies
+            archive_max_dim (int): Longest side of archived images, in pixels
+            archive_quality (int): JPEG quality of archived images
+            sweep_interval (float): Seconds between background sweeps
+            is_live (callable): Called with a session id; sessions for which
+                it returns True are skipped when enforcing the quota
+        """
+        self.root = root
+        self.retention = retention
+        self.archive_after = archive_after
+        self.quota_bytes = quota_bytes
+        self.archive = archive
+        self.archive_max_dim = archive_max_dim
+        self.archive_quality = archive_quality
+        self.sweep_interval = sweep_interval
+        self.is_live = is_live
+        self._sweeper = None
+        self._sweeper_pid = None
+        self._last_sweep = None
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def session_dir(self, session_id):
+        """
+        Directory holding a session's files (created if missing)
+
+        Args:
+            session_id (str): Session identifier
+
+        Returns:
+            str: Absolute directory path
+        """
+        path = os.path.join(self.root, os.path.basename(session_id))
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        return path
+
+    def session_path(self, session_id, filename):
+        """Path for a file stored in a session's directory"""
+        return os.path.join(self.session_dir(session_id), filename)
+
+    def resolve(self, path):
+        """
+        Find a stored file, which may have been replaced by its archival copy
+
+        Args:
+            path (str): Path the file was originally saved at
+
+        Returns:
+            str: Existing path, or None if the file is gone
+        """
+        if os.path.exists(path):
+            return path
+        archived = path + ARCHIVE_SUFFIX
+        return archived if os.path.exists(archived) else None
+
+    def remove_file(self, path):
+        """Delete a stored file and its archival copy, if present"""
+        for candidate in (path, path + ARCHIVE_SUFFIX):
+            if os.path.exists(candidate):
+                os.remove(candidate)
+
+    def remove_session(self, session_id):
+        """Delete a session's directory and everything in it"""
+        path = os.path.join(self.root, os.path.basename(session_id))
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _session_files(self):
+        """All files in session directories as (path, size, mtime)"""
+        files = []
+        for entry in os.scandir(self.root):
+            # Only session directories are managed; loose legacy files are left alone
+            if not entry.is_dir():
+                continue
+            for dirpath, _, filenames in os.walk(entry.path):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((path, st.st_size, st.st_mtime))
+        return files
+
+    def archive_image(self, path):
+        """
+        Replace an image with a downscaled, recompressed JPEG copy
+
+        Args:
+            path (str): Image to archive
+
+        Returns:
+            str: Path of the archival copy, or None if it was not archived
+        """
+        import cv2
+
+        img = cv2.imread(path)
+        if img is None:
+            return None
+        height, width = img.shape[:2]
+        scale = self.archive_max_dim / max(height, width)
+        if scale < 1:
+            img = cv2.resize(img, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        archived = path + ARCHIVE_SUFFIX
+        if not cv2.imwrite(archived, img, [cv2.IMWRITE_JPEG_QUALITY, self.archive_quality]):
+            return None
+        st = os.stat(path)
+        if os.path.getsize(archived) >= st.st_size:
+            # Already compact enough; keep the original bytes under the archive name
+            os.replace(path, archived)
+            return archived
+        # Keep the original's age so retention still counts from the upload
+        os.utime(archived, (st.st_atime, st.st_mtime))
+        os.remove(path)
+        return archived
+
+    def sweep(self):
+        """
+        Apply archival, retention and quota rules once
+
+        Returns:
+            dict: Counts of archived and deleted files
+        """
+        now = time.time()
+        archived = deleted = 0
+        kept = []
+        for path, size, mtime in self._session_files():
+            age = now - mtime
+            try:
+                if age > self.retention:
+                    os.remove(path)
+                    deleted += 1
+                    continue
+                extension = path.rsplit('.', 1)[-1].lower()
+                if (self.archive and age > self.archive_after and extension in IMAGE_EXTENSIONS
+                        and not path.endswith(ARCHIVE_SUFFIX)
+                        and os.path.basename(os.path.dirname(path)) not in NO_ARCHIVE_DIRS):
+                    archived_path = self.archive_image(path)
+                    if archived_path is not None:
+                        archived += 1
+                        path, size = archived_path, os.path.getsize(archived_path)
+                kept.append((path, size, mtime))
+            except FileNotFoundError:
+                # Removed concurrently (another worker's sweep or a cleared session)
+                continue
+
+        # Enforce the quota, oldest files of sessions no longer in use first
+        total = sum(size for _, size, _ in kept)
+        live = {}
+        for path, size, _ in sorted(kept, key=lambda f: f[2]):
+            if total <= self.quota_bytes:
+                break
+            session_id = os.path.relpath(path, self.root).split(os.sep)[0]
+            if session_id not in live:
+                live[session_id] = self.is_live is not None and self.is_live(session_id)
+            if live[session_id]:
+                continue
+            try:
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        if total > self.quota_bytes:
+            logger.warning(f"Upload storage over quota ({total} bytes) with only live sessions left")
+
+        # Drop session directories left empty (not ones just created for an upload)
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and now - entry.stat().st_mtime > 60:
+                try:
+                    os.rmdir(entry.path)
+                except OSError:
+                    pass
+
+        self._last_sweep = now
+        if archived or deleted:
+            logger.info(f"Storage sweep archived {archived} and deleted {deleted} files")
+        return {'archived': archived, 'deleted': deleted}
+
+    def start_sweeper(self):
+        """Run sweep() periodically in a daemon thread (once per process)"""
+        # Threads do not survive a fork, so a preloaded master's sweeper is
+        # replaced by one per worker
+        if self._sweeper is not None and self._sweeper_pid == os.getpid():
+            return self._sweeper
+
+        def _run():
+            while True:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Error sweeping upload storage: {str(e)}")
+                time.sleep(self.sweep_interval)
+
+        self._sweeper = threading.Thread(target=_run, name='storage-sweeper', daemon=True)
+        self._sweeper_pid = os.getpid()
+        self._sweeper.start()
+        return self._sweeper
+
+    def stats(self):
+        """
+        Storage usage for monitoring
+
+        Returns:
+            dict: Session directory count, file count, bytes used and limits
+        """
+        files = self._session_files()
+        return {
+            'sessions': len({os.path.relpath(p, self.root).split(os.sep)[0] for p, _, _ in files}),
+            'files': len(files),
+            'archived_files': sum(1 for p, _, _ in files if p.endswith(ARCHIVE_SUFFIX)),
+            'bytes': sum(size for _, size, _ in files),
+            'quota_bytes': self.quota_bytes,
+            'last_sweep': self._last_sweep
+        }